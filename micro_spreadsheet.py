@@ -1,16 +1,35 @@
-
 import argparse
-import copy
+import array
+import bisect
+import codecs
+import collections
+import csv
+import functools
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import json
+import marshal
 import math
+import mmap
+import operator
 import os
 import re
+import select
 import shutil
 import signal
 import subprocess
 import sys
 import termios
+import time
 import tty
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 '''
 Features
@@ -21,8 +40,19 @@ Features
 
 '''
 ANSII_RESET = "\033[0m"
-operators = {'+', '-', '/', '*', '//', '**', '(', ')', ':'}
-functions = {'sum', 'avg', 'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh', 'log', 'ln', 'sqrt'}
+CYCLE_ERROR = '#CYCLE'
+DIV_ZERO_ERROR = '#DIV/0'
+REF_ERROR = '#REF'          # references copied past the top or left of the sheet
+VALUE_ERROR = '#VALUE'      # text used in math, a number out of a function's domain, or an equation that can't be read
+NA_ERROR = '#N/A'           # lookups that found nothing
+error_values = {CYCLE_ERROR, DIV_ZERO_ERROR, REF_ERROR, VALUE_ERROR, NA_ERROR}
+operators = {'+', '-', '/', '*', '//', '**', '(', ')', ':', ',', '<', '>', '=', '<=', '>=', '<>'}
+functions = {
+    'sum', 'avg', 'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh', 'log', 'ln', 'sqrt',
+    'vlookup', 'match', 'countif', 'sumif', 'min', 'max', 'count', 'median', 'stdev', 'var',
+    'if', 'and', 'or', 'iferror'
+}
+branching_functions = {'if', 'and', 'or', 'iferror'}  # only work out the arguments they need
 constants = {'pi', 'e'}
 math_functions = {
     'sin': math.sin,
@@ -40,8 +70,25 @@ math_functions = {
     'pi': math.pi,
     'e': math.e,
 }
+vector_math_functions = {} if numpy == None else {
+    'sin': numpy.sin,
+    'cos': numpy.cos,
+    'tan': numpy.tan,
+    'asin': numpy.arcsin,
+    'acos': numpy.arccos,
+    'atan': numpy.arctan,
+    'sinh': numpy.sinh,
+    'cosh': numpy.cosh,
+    'tanh': numpy.tanh,
+    'log': numpy.log10,
+    'ln': numpy.log,
+    'sqrt': numpy.sqrt,
+    'pi': math.pi,
+    'e': math.e,
+}
 
 
+@functools.lru_cache(maxsize=65536)
 def convert_cell_name_to_x_y(name: str) -> tuple[int, int]:
     col = []
     last = 0
@@ -69,6 +116,7 @@ def convert_cell_name_to_x_y(name: str) -> tuple[int, int]:
 
     return x, y
 
+@functools.lru_cache(maxsize=4096)
 def convert_x_to_alpha_value(x: int):
     result = []
     x+=1
@@ -81,31 +129,34 @@ def convert_x_to_alpha_value(x: int):
     
     return ''.join(reversed(result))
 
+def convert_x_y_to_cell_name(x: int, y: int) -> str:
+    return convert_x_to_alpha_value(x) + str(y)
 
-def substitute_if_ref(value: str, equation_targets: {str, float}) -> tuple[bool, str]:
 
-    float_value = 0.0
-    try:
-        float_value = float(value)
-    except ValueError:
-        if value in equation_targets:
-            if equation_targets[value] != None:
-                float_value = equation_targets[value]
-            else:
-                return True, float_value
-        else:
-            x, y = convert_cell_name_to_x_y(value)
-            if (y < len(cells) and x < len(cells[y])):
-                try:
-                    float_value = float(cells[y][x])
-                except ValueError:
+def get_cell_operand(x: int, y: int):
+    # a referenced cell as a number, or the error it stands for
 
-                    if cells[y][x] == "":
-                        return False, float_value
+    # copied past the top or left of the sheet
+    if x < 0 or y < 0:
+        return REF_ERROR
 
-                    return False, cells[y][x]
+    row = get_row(y)
+    value = '' if row == None else row.get(x, '')
 
-    return False, float_value
+    # equation results are already numbers
+    if value.__class__ is float:
+        return value
+    if value == '':
+        return 0.0
+
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        # referenced equation failed
+        if value in error_values:
+            return value
+        # text can't be used in math
+        return VALUE_ERROR
 
 
 def wrap(width: int, str: str) -> str:
@@ -240,6 +291,36 @@ def tokenize_equation(equation: str) -> list[str]:
 
     return tokens
 
+def convert_equation_to_template(equation: str, x: int, y: int) -> str:
+    # a3=a1+b2 becomes R[-2]C[0]+R[-1]C[1], the same for every cell it's copied to
+    tokens = tokenize_equation(equation)
+    for i, token in enumerate(tokens):
+        if token in functions or token in math_functions or not is_cell_name(token):
+            continue
+        other_x, other_y = convert_cell_name_to_x_y(token)
+        tokens[i] = f'R[{other_y - y}]C[{other_x - x}]'
+
+    return sys.intern(''.join(tokens))
+
+def convert_template_to_equation(template: str, x: int, y: int) -> str:
+    def convert_reference(match) -> str:
+        other_x, other_y = x + int(match.group(2)), y + int(match.group(1))
+        # copied past the top or left of the sheet
+        if other_x < 0 or other_y < 0:
+            return REF_ERROR
+        return convert_x_y_to_cell_name(other_x, other_y)
+    return template_reference_pattern.sub(convert_reference, template)
+
+@functools.lru_cache(maxsize=4096)
+def get_template_reach(template: str) -> tuple[int, int]:
+    # how far left and up the references of a template go
+    offsets = [(int(match.group(2)), int(match.group(1))) for match in template_reference_pattern.finditer(template)]
+    return min([offset_x for offset_x, offset_y in offsets], default=0), min([offset_y for offset_x, offset_y in offsets], default=0)
+
+def has_off_sheet_reference(template: str, x: int, y: int) -> bool:
+    reach_x, reach_y = get_template_reach(template)
+    return x + reach_x < 0 or y + reach_y < 0
+
 def is_equation(str: str) -> bool:
     global operators, functions
 
@@ -256,14 +337,26 @@ def is_equation(str: str) -> bool:
         # split by operators
         tokens = tokenize_equation(str)
         number_regex = r'^\d*\.?\d+$'  # start, 0 or more digit, ., 1 or more digit, finish
+        if all(token in operators for token in tokens):
+            return False
+
+        depth = 0
         for i, token in enumerate(tokens):
+            # commas only separate function arguments, 1,2 is text
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif token == ',' and depth <= 0:
+                return False
+
             if token not in operators:
                 if not is_cell_name(token):
                     is_number = re.search(number_regex, token)
                     if not is_number:
                         next = None if len(tokens) <= i+1 else tokens[i+1]
                         is_function = token in functions and next == '('
-                        is_constant = token in constants
+                        is_constant = token in constants or token == REF_ERROR
                         if not is_function and not is_constant:
                             return False
                         
@@ -357,19 +450,30 @@ def hsl_to_rgb(h, s, l):
 parser = argparse.ArgumentParser(description="A terminal app for editing csv's or making spreadsheets")
 parser.add_argument('file', nargs='?', help='path to your csv or spreadsheet file. otherwise a new file is opened')
 parser.add_argument('-c', '--commands', required=False, action='store_true', help='whether to show command hints during editing')
+parser.add_argument('-k', '--cache', required=False, action='store_true', help='keep the parsed and calculated sheet in a .msc file next to the csv, so reopening it unchanged skips parsing and calculating')
+parser.add_argument('-l', '--lazy', required=False, action='store_true', help='map the file and only parse rows as they are viewed or referenced, for browsing large csv files')
 args = parser.parse_args()
 
 FILE = args.file
 NO_COMMANDS = not args.commands
+LAZY = args.lazy
+CACHE = args.cache
+CACHE_VERSION = 6
 PRECISION = 4
 WRAP_WIDTH = 20
-
-cells=[['']]
+MIN_FILL_DOWN_RUN = 8
+ROW_CACHE_SIZE = 2048
+MAP_BLOCK_SIZE = 1 << 20
+SAVE_BUFFER_SIZE = 1 << 20
+MAX_UNDO_CHANGES = 1 << 20
+JOURNAL_SYNC_SECONDS = 1.0
+
+cells = {}  # sparse, row number -> {column number: value}. empty cells aren't stored
 width=1
 height=1
-equations = {}
-colors = {}
-wrapped_cell_names = set()
+equations = {}      # (x, y) -> equation template, references are offsets from (x, y) so copies share it
+colors = {}         # (x, y) -> [r, g, b]
+wrapped_cells = set()
 current_cell = 'a0'
 selected_cells = []
 clip_board = []
@@ -378,69 +482,659 @@ is_selecting = False
 
 actions = []
 undone_actions = []
+current_action = None   # the action being recorded, changes to a target are kept the first time it changes
+undo_size = 0
+
+# edits since the last save are appended to FILE.journal, so a crashed session can be recovered
+journal_file = None
+journal_pending = set()     # (kind, target) changed since the journal was last written
+journal_synced = 0.0
+journal_unsynced = False    # whether the journal was written since it was last synced
 
 command_stack = []
+key_buffer = collections.deque()    # keys read from stdin that haven't been handled yet
+key_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+loading_records = None  # rows of FILE still to be read
+unsaved_changes = False
+saved_as = None         # (FILE, width, height) when last loaded or saved
+
+# lazy mode, rows of the mapped file are parsed on demand. edited rows are copied into cells
+mapped_file = None
+row_starts = array.array('Q')
+row_ends = array.array('Q')
+mapped_width = 0
+row_cache = collections.OrderedDict()   # row number -> parsed row, least recently used first
+quoted_cell_pattern = re.compile(rb'"(?<![^,\n]")[^"]*(?:""[^"]*)*"')    # only quotes starting a cell, quotes inside unquoted text are kept
+open_quote_pattern = re.compile(rb'"(?<![^,\n]")')
+skipped_line_pattern = re.compile(rb'^(?:<meta>.*|\r?)$', re.MULTILINE)
+template_reference_pattern = re.compile(r'R\[(-?\d+)\]C\[(-?\d+)\]')
+
+# dependency graph between equations, so only what changed gets recalculated
+equation_references = {}    # target -> (x, y) cells referenced by its equation
+equation_ranges = {}        # target -> (startx, starty, endx, endy) ranges referenced by its equation
+equation_dependents = {}    # (x, y) -> targets whose equation references it
+range_columns = {}          # x -> (starty, endy, target) for the ranges over that column
+equation_branch_reads = {}  # target -> cells and ranges read by the branches its equation took last time
+branch_reads = []           # what the branches taken by the equation being evaluated read
+dirty_cells = set()
+dirty_equations = set()
+rebuild_dependencies = True
+
+# equation template -> (program, source, cell offsets, range offsets, lookup offsets, branches)
+compiled_equations = {}
+assembled_programs = {}     # equation template -> the program put together to run
+
+# instructions of a program, each is (instruction, argument)
+PUSH = 0            # push the number argument
+LOAD_CELL = 1       # push the value of a referenced cell
+LOAD_TOTAL = 2      # push the total of a summed range
+LOAD_ARGUMENT = 3   # push what a lookup or aggregate is given
+NEGATE = 4
+ADD = 5
+SUBTRACT = 6
+MULTIPLY = 7
+DIVIDE = 8
+FLOOR_DIVIDE = 9
+POWER = 10
+CALL = 11           # argument is (function name, number of arguments)
+LESS = 12
+GREATER = 13
+LESS_EQUAL = 14
+GREATER_EQUAL = 15
+EQUAL = 16
+NOT_EQUAL = 17
+binary_instructions = {
+    '+': ADD, '-': SUBTRACT, '*': MULTIPLY, '/': DIVIDE, '//': FLOOR_DIVIDE, '**': POWER,
+    '<': LESS, '>': GREATER, '<=': LESS_EQUAL, '>=': GREATER_EQUAL, '=': EQUAL, '<>': NOT_EQUAL
+}
+binary_operations = {ADD: operator.add, SUBTRACT: operator.sub, MULTIPLY: operator.mul}
+comparison_operations = {
+    LESS: operator.lt, GREATER: operator.gt, LESS_EQUAL: operator.le,
+    GREATER_EQUAL: operator.ge, EQUAL: operator.eq, NOT_EQUAL: operator.ne
+}
+binding_powers = {'+': 10, '-': 10, '*': 20, '/': 20, '//': 20, '**': 30, '<': 5, '>': 5, '<=': 5, '>=': 5, '=': 5, '<>': 5}
+UNARY_BINDING_POWER = 25    # -a*b is (-a)*b, -a**b is -(a**b)
+
+# column -> prefix sums used by sum() and avg(), dropped when the column changes
+column_prefix_sums = {}
+
+# column -> {key: rows with that key, in order} used by lookups, dropped when the column changes
+column_indexes = {}
+
+# (kind, startx, starty, endx, endy) -> what min(), median() etc. worked out for a range,
+# dropped when any column it covers changes
+range_statistics = {}
+statistics_columns = {}     # column -> keys of range_statistics covering it
+
+# column widths and row heights, kept up to date as cells change so DISPLAY doesn't measure every cell
+column_cell_widths = {}     # column -> Counter of the widths of its cells
+row_cell_lines = {}         # row -> Counter of the line counts of its wrapped cells, when more than one
+column_widths = []
+row_heights = []
+column_tree = []            # fenwick trees over column widths (plus borders) and row heights
+row_tree = []
+layout_changes = {}         # (x, y) -> (width, lines) it measured before it changed
+layout_equations = False    # whether cells were measured with their equations shown
+rebuild_layout = True
+
+# how many values and equations each row and column holds, so the used area is known without a scan
+row_counts = {}
+column_counts = {}
+used_rows = []              # max-heaps (negated) of rows and columns that have held something, emptied ones are dropped when they reach the top
+used_columns = []
+rebuild_bounds = True
+
+# lines DISPLAY last drew from the top of the terminal, cleared when anything else is printed over them
+screen_lines = []
+screen_size = None
+
+
+
+def parse_mapped_row(y: int) -> dict[int, str]:
+    text = mapped_file[row_starts[y]:row_ends[y]].decode('utf-8')
+    record = next(csv.reader([text]), [])
+    return {x: parse_cell_value(cell) for x, cell in enumerate(record) if cell != ''}
+
+def get_row(y: int) -> dict[int, str]:
+    # edited rows live in cells, the rest of a mapped file is parsed when it's needed
+    row = cells.get(y)
+    if row != None or y >= len(row_starts):
+        return row
+
+    row = row_cache.get(y)
+    if row != None:
+        row_cache.move_to_end(y)
+        return row
+
+    row = parse_mapped_row(y)
+    row_cache[y] = row
+    if len(row_cache) > ROW_CACHE_SIZE:
+        row_cache.popitem(last=False)
+    return row
+
+def count_occupied(counts: dict[int, int], heap: list[int], i: int, count: int):
+    total = counts.get(i, 0) + count
+    if total == 0:
+        del counts[i]
+        return
 
+    counts[i] = total
+    if total == count:
+        heapq.heappush(heap, -i)
+
+        # entries of emptied rows or columns pile up, so start over once they outnumber the rest
+        if len(heap) > 2 * len(counts) + 64:
+            heap[:] = [-i for i in counts]
+            heapq.heapify(heap)
+
+def count_cell(x: int, y: int, count: int):
+    count_occupied(row_counts, used_rows, y, count)
+    count_occupied(column_counts, used_columns, x, count)
+
+def last_occupied(counts: dict[int, int], heap: list[int]) -> int:
+    # one past the last row or column holding anything
+    while len(heap) > 0 and -heap[0] not in counts:
+        heapq.heappop(heap)
+    return -heap[0] + 1 if len(heap) > 0 else 0
+
+def read_mapped_rows():
+    # copies every row of a mapped file into cells, for changes that touch all of them
+    for y in range(len(row_starts)):
+        if y not in cells:
+            row = cells[y] = parse_mapped_row(y)
+            for x in row:
+                count_cell(x, y, 1)
+    row_cache.clear()
+
+def set_cell(cells: dict[int, dict[int, str]], x: int, y: int, value: str):
+    global width, height, colors, unsaved_changes
+
+    # grow the sheet to fit
+    height = max(height, y+1)
+    width = max(width, x+1)
 
+    # set in cells (numbers are kept as floats and only formatted for display or saving)
+    if value.__class__ is str:
+        value = parse_cell_value(value)
+    row = get_row(y)
+    old_value = '' if row == None else row.get(x, '')
+    if value != old_value:
+        record_undo('cells', (x, y), old_value)
+    if row != None and y not in cells:
+        row = cells[y] = dict(row)
+        for row_x in row:
+            count_cell(row_x, y, 1)
+    if value == '':
+        if row != None and x in row:
+            del row[x]
+            # emptied rows of a mapped file stay, so the file's row isn't shown through
+            if len(row) == 0 and y >= len(row_starts):
+                del cells[y]
+    else:
+        if row == None:
+            row = cells[y] = {}
+        row[x] = value
 
-def set_cell(cells: list[list[str]], x: int, y: int, value: str):
-    global width, height, colors
+    if (old_value == '') != (value == ''):
+        count_cell(x, y, 1 if old_value == '' else -1)
 
-    # add missing cells
-    while y >= len(cells):
-        cells.append([])
-    height = len(cells)
-    while x >= len(cells[y]):
-        cells[y].append('')
-    width = max(width, x+1)
+    if value != old_value:
+        dirty_cells.add((x, y))
+        column_prefix_sums.pop(x, None)
+        column_indexes.pop(x, None)
+        for key in statistics_columns.pop(x, ()):
+            range_statistics.pop(key, None)
+        unsaved_changes = True
+
+    # wipe color if blank
+    if value == '' and (x, y) in colors:
+        record_undo('colors', (x, y), colors.pop((x, y)))
+        unsaved_changes = True
 
-    # set in cells (and format if float)
+def format_cell_value(value) -> str:
     if isinstance(value, float):
-        int_resolution = int(value)
-        if int_resolution == value:
-            value = int_resolution
+        if value.is_integer():
+            return str(int(value))
         precision = get_float_precision(value)
         precision = min(PRECISION, precision)
-        cells[y][x] = f"{value:.{precision}f}"
-    else:
-        cells[y][x] = value
-
-    # wipe color if blank
-    if value == '':
-        cell_name = convert_x_to_alpha_value(x) + str(y)
-        if cell_name in colors:
-            del colors[cell_name]
-
-def get_cell(cells: list[list[str]], x: int, y: int) -> str:
-    if y < len(cells):
-        if x < len(cells[y]):
-            return cells[y][x]
+        return f"{value:.{precision}f}"
+
+    return value
+
+def parse_cell_value(value: str):
+    # numbers typed in or read from the csv are parsed once, but only when they'd be
+    # written back out the same way. anything else (e.g. 007, 2.50 or 3.14159) is kept as text
+    if value == '' or not (value[0].isdigit() or value[0] == '-'):
+        return value
+    point = value.find('.')
+    if point != -1 and (value[-1] == '0' or len(value) - point - 1 > PRECISION):
+        return value
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    if math.isfinite(number) and format_cell_value(number) == value:
+        return number
+    return value
+
+def get_cell(cells: dict[int, dict[int, str]], x: int, y: int) -> str:
+    if y < height and x < width:
+        row = get_row(y)
+        return '' if row == None else row.get(x, '')
         
     return None
 
 def get_equation(x: int, y: int) -> str:
-    cell_name = convert_x_to_alpha_value(x) + str(y)
-    if cell_name in equations:
-        return '=' + equations[cell_name]
+    if (x, y) in equations:
+        return '=' + convert_template_to_equation(equations[(x, y)], x, y)
     
     return None
 
-def modify_equation(source_cell_name: str, source_x: int, source_y: int, target_x: int, target_y: int) -> str:
-    equation = equations[source_cell_name]
-    tokens = tokenize_equation(equation)
-    for i, token in enumerate(tokens):
-        try:
-            float(token)
-        except ValueError:
-            # find equivalent cell
-            if token not in operators and token not in functions:
-                other_x, other_y = convert_cell_name_to_x_y(token)
-                offset_x = other_x - source_x
-                offset_y = other_y - source_y
-                equivalent_cell_name = convert_x_to_alpha_value(target_x + offset_x) + str(target_y + offset_y)
-                tokens[i] = equivalent_cell_name
+def set_equation(x: int, y: int, template: str):
+    global unsaved_changes
+    record_undo('equations', (x, y), equations.get((x, y)))
+    if (x, y) not in equations:
+        count_cell(x, y, 1)
+    equations[(x, y)] = template
+    dirty_equations.add((x, y))
+    unsaved_changes = True
+
+def remove_equation(x: int, y: int):
+    global unsaved_changes
+    if (x, y) in equations:
+        record_undo('equations', (x, y), equations[(x, y)])
+        count_cell(x, y, -1)
+        del equations[(x, y)]
+        dirty_equations.add((x, y))
+        unsaved_changes = True
+
+        # the result left in the cell is its own value now, even if the same number is typed over it
+        journal_pending.add(('cells', (x, y)))
+
+def compile_equation(template: str) -> tuple:
+    # templates are compiled once and shared by every cell they were copied to
+    if template in compiled_equations:
+        return compiled_equations[template]
+
+    # references are held as _o0, _o1... while the rest is tokenized
+    held = []
+    def hold_reference(match):
+        held.append((int(match.group(2)), int(match.group(1))))
+        return '_o' + str(len(held) - 1)
+    tokens = tokenize_equation(template_reference_pattern.sub(hold_reference, template))
+
+    # the tokenizer splits **, //, <=, >= and <> into single characters
+    merged = []
+    for token in tokens:
+        if len(merged) > 0 and merged[-1] + token in {'**', '//', '<=', '>=', '<>'}:
+            merged[-1] = merged[-1] + token
+        else:
+            merged.append(token)
+    tokens = merged
+
+    # a pratt parser writes the equation out as a postfix program. cells are loaded
+    # from references, sum() and avg() from ranges, and what lookups and aggregates
+    # are given (cells as they are, not as numbers, and whole ranges) from lookups
+    references = []
+    ranges = []
+    lookups = []
+    program = []
+    position = 0
+    branch_depth = 0        # how many arguments of if(), and(), or() and iferror() that might be skipped we're in
+    unconditional = set()   # loads that are made whatever branches are taken
+
+    def load(instruction: int, index: int):
+        program.append((instruction, index))
+        if branch_depth == 0:
+            unconditional.add((instruction, index))
+
+    def peek() -> str:
+        return tokens[position] if position < len(tokens) else None
+
+    def expect(token: str):
+        nonlocal position
+        if peek() != token:
+            raise ValueError(token)
+        position += 1
+
+    def is_range_end(token: str) -> bool:
+        return token.startswith('_o') or token == REF_ERROR
+
+    def parse_range() -> tuple[int, int, int, int]:
+        # None when an end was copied off the sheet
+        nonlocal position
+        if position+2 >= len(tokens) or not is_range_end(tokens[position]) or tokens[position+1] != ':' or not is_range_end(tokens[position+2]):
+            raise ValueError('range')
+        if REF_ERROR in {tokens[position], tokens[position+2]}:
+            position += 3
+            return None
+        (startx, starty), (endx, endy) = held[int(tokens[position][2:])], held[int(tokens[position+2][2:])]
+        position += 3
+        return min(startx, endx), min(starty, endy), max(startx, endx), max(starty, endy)
+
+    def parse_call(name: str):
+        nonlocal position, branch_depth
+        expect('(')
+        if name in {'sum', 'avg'}:
+            # a3=sum(a1:a2)
+            # ranges are summed natively, the program just gets the total
+            cell_range = parse_range()
+            expect(')')
+            if cell_range == None:
+                program.append((PUSH, REF_ERROR))
+                return
+            startx, starty, endx, endy = cell_range
+            load(LOAD_TOTAL, len(ranges))
+            ranges.append((startx, starty, endx, endy))
+            if name == 'avg':
+                program.append((PUSH, float((endx - startx + 1) * (endy - starty + 1))))
+                program.append((DIVIDE, None))
+            return
+
+        count = 0
+        is_range = []   # whether each argument was given as a range
+        while peek() != ')':
+            if peek() == None:
+                raise ValueError('end')
+            if count > 0:
+                expect(',')
+            following = tokens[position+1] if position+1 < len(tokens) else None
+            is_range.append(name in range_functions and is_range_end(peek()) and following == ':')
+            if is_range[-1]:
+                # vlookup(a1, b0:c9, 2)
+                cell_range = parse_range()
+                if cell_range == None:
+                    program.append((PUSH, REF_ERROR))
+                else:
+                    load(LOAD_ARGUMENT, len(lookups))
+                    lookups.append(cell_range)
+            elif name in range_functions and peek().startswith('_o') and following in {',', ')'}:
+                load(LOAD_ARGUMENT, len(lookups))
+                lookups.append(held[int(peek()[2:])])
+                position += 1
+            elif name in branching_functions and count > 0:
+                # if(a1>0, b1, c1) only ever works out one of b1 and c1
+                branch_depth += 1
+                parse(0)
+                branch_depth -= 1
+            else:
+                parse(0)
+            count += 1
+        expect(')')
+
+        if name == 'if' and count not in {2, 3} or name == 'iferror' and count != 2 or name in {'and', 'or'} and count == 0:
+            raise ValueError(name)
+        if name in lookup_arguments and lookup_arguments[name].get(count) != is_range:
+            raise ValueError(name)
+        if name in aggregate_functions and count == 0:
+            raise ValueError(name)
+        program.append((CALL, (name, count)))
+
+    def parse_operand():
+        nonlocal position
+        token = peek()
+        if token == None:
+            raise ValueError('end')
+        position += 1
+
+        if token == '(':
+            parse(0)
+            expect(')')
+        elif token in {'-', '+'}:
+            parse(UNARY_BINDING_POWER)
+            if token == '-':
+                program.append((NEGATE, None))
+        elif token.startswith('_o'):
+            reference = held[int(token[2:])]
+            if reference not in references:
+                references.append(reference)
+            load(LOAD_CELL, references.index(reference))
+        elif token in constants:
+            program.append((PUSH, math_functions[token]))
+        elif token == REF_ERROR:
+            program.append((PUSH, REF_ERROR))
+        elif token in functions and peek() == '(':
+            parse_call(token)
+        else:
+            program.append((PUSH, float(token)))
+
+    def parse(binding_power: int):
+        nonlocal position
+        parse_operand()
+        while peek() in binary_instructions and binding_powers[peek()] > binding_power:
+            token = peek()
+            position += 1
+            # ** groups to the right, everything else to the left
+            parse(binding_powers[token] - 1 if token == '**' else binding_powers[token])
+            program.append((binary_instructions[token], None))
 
-    return ''.join(tokens)
+    try:
+        parse(0)
+        if position != len(tokens):
+            raise ValueError('end')
+    except (ValueError, IndexError):
+        program = None
+
+    # equations with branches keep which loads are only made inside them. None when there are no branches
+    branches = None
+    if program != None and any(instruction == CALL and argument[0] in branching_functions for instruction, argument in program):
+        branches = {
+            (instruction, argument) for instruction, argument in program
+            if instruction in {LOAD_CELL, LOAD_TOTAL, LOAD_ARGUMENT} and (instruction, argument) not in unconditional
+        }
+
+    # equations copied down a column compile to the same program
+    compiled = (program, repr(program), references, ranges, lookups, branches)
+    compiled_equations[template] = compiled
+    return compiled
+
+def add_equation_dependencies(target: tuple[int, int]):
+    x, y = target
+    program, source, offsets, range_offsets, lookups, branches = compile_equation(equations[target])
+
+    # what branches read only counts when they were taken
+    if branches != None:
+        offsets = [offset for i, offset in enumerate(offsets) if (LOAD_CELL, i) not in branches]
+        range_offsets = [offset for i, offset in enumerate(range_offsets) if (LOAD_TOTAL, i) not in branches]
+        lookups = [lookup for i, lookup in enumerate(lookups) if (LOAD_ARGUMENT, i) not in branches]
+    reads = equation_branch_reads.get(target, [])
+
+    references = {(x + offset_x, y + offset_y) for offset_x, offset_y in offsets}
+    references.update((x + lookup[0], y + lookup[1]) for lookup in lookups if len(lookup) == 2)
+    references.update(read for read in reads if len(read) == 2)
+    equation_references[target] = references
+    range_offsets = range_offsets + [lookup for lookup in lookups if len(lookup) == 4]
+    ranges = [(x + startx, y + starty, x + endx, y + endy) for startx, starty, endx, endy in range_offsets]
+    ranges.extend(read for read in reads if len(read) == 4)
+    if len(ranges) > 0:
+        equation_ranges[target] = ranges
+        add_range_columns(target, ranges)
+    for cell in references:
+        if cell not in equation_dependents:
+            equation_dependents[cell] = set()
+        equation_dependents[cell].add(target)
+
+def remove_equation_dependencies(target: tuple[int, int]):
+    for cell in equation_references.pop(target, set()):
+        dependents = equation_dependents.get(cell)
+        if dependents != None:
+            dependents.discard(target)
+            if len(dependents) == 0:
+                del equation_dependents[cell]
+    for startx, starty, endx, endy in equation_ranges.pop(target, ()):
+        for x in range(startx, endx+1):
+            columns = range_columns.get(x)
+            if columns != None:
+                columns.discard((starty, endy, target))
+                if len(columns) == 0:
+                    del range_columns[x]
+
+def add_range_columns(target: tuple[int, int], ranges: list[tuple[int, int, int, int]]):
+    # ranges are kept by the columns they cover, so a cell is only checked against ranges over its column
+    for startx, starty, endx, endy in ranges:
+        for x in range(startx, endx+1):
+            if x not in range_columns:
+                range_columns[x] = set()
+            range_columns[x].add((starty, endy, target))
+
+def set_branch_reads(target: tuple[int, int], reads: list[tuple], merge: bool = False):
+    # the branches an equation took are its dependencies until it takes different ones
+    reads = list(dict.fromkeys(reads))
+    if merge:
+        reads = list(dict.fromkeys(equation_branch_reads.get(target, []) + reads))
+    if reads == equation_branch_reads.get(target, []):
+        return
+
+    remove_equation_dependencies(target)
+    if len(reads) > 0:
+        equation_branch_reads[target] = reads
+    else:
+        equation_branch_reads.pop(target, None)
+    add_equation_dependencies(target)
+
+def reads_pending_equations(reads: list[tuple], pending: set[tuple[int, int]], pending_rows: dict[int, list[int]]) -> bool:
+    # whether a branch read an equation before it was worked out. pending_rows holds the sorted rows of pending equations, by column
+    for read in reads:
+        if len(read) == 2:
+            if read in pending:
+                return True
+            continue
+
+        startx, starty, endx, endy = read
+        for x in range(startx, endx+1):
+            rows = pending_rows.get(x, [])
+            for y in rows[bisect.bisect_left(rows, starty):bisect.bisect_right(rows, endy)]:
+                if (x, y) in pending:
+                    return True
+    return False
+
+def find_dependent_equations(changed_cells: set[tuple[int, int]]) -> set[tuple[int, int]]:
+    # walk the graph downstream from the changed cells
+    found = set()
+    stack = list(changed_cells)
+    while len(stack) > 0:
+        cell = stack.pop()
+        targets = set(equation_dependents.get(cell, ()))
+        x, y = cell
+        for starty, endy, target in range_columns.get(x, ()):
+            if starty <= y <= endy:
+                targets.add(target)
+        for target in targets:
+            if target not in found:
+                found.add(target)
+                stack.append(target)
+
+    return found
+
+def get_equation_precedents(target: tuple[int, int], equation_rows: dict[int, list[int]]) -> set[tuple[int, int]]:
+    # equation_rows holds the sorted rows of the equations that can be precedents, by column
+    precedents = {cell for cell in equation_references.get(target, ()) if cell in equations}
+    for startx, starty, endx, endy in equation_ranges.get(target, ()):
+        for x in range(startx, endx+1):
+            rows = equation_rows.get(x, [])
+            for y in rows[bisect.bisect_left(rows, starty):bisect.bisect_right(rows, endy)]:
+                precedents.add((x, y))
+    return precedents
+
+def find_strongly_connected_components(edges: list[list[int]]) -> list[list[int]]:
+    # tarjan's algorithm, iterative so long chains don't hit the recursion limit.
+    # components come out after everything they have edges to
+    index = [-1] * len(edges)
+    low = [0] * len(edges)
+    on_stack = [False] * len(edges)
+    stack = []
+    components = []
+    counter = 0
+    for root in range(len(edges)):
+        if index[root] != -1: continue
+
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, iter(edges[root]))]
+        while len(work) > 0:
+            node, children = work[-1]
+            advanced = False
+            for child in children:
+                if index[child] == -1:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, iter(edges[child])))
+                    advanced = True
+                    break
+                elif on_stack[child]:
+                    low[node] = min(low[node], index[child])
+            if advanced: continue
+
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node: break
+                components.append(component)
+
+    return components
+
+def get_precedent_runs(runs: list[list[tuple[int, int]]]) -> list[list[int]]:
+    # for each run, the runs it uses
+    run_of = {}
+    equation_rows = {}
+    for i, run in enumerate(runs):
+        for target in run:
+            run_of[target] = i
+            if target[0] not in equation_rows:
+                equation_rows[target[0]] = []
+            equation_rows[target[0]].append(target[1])
+    for rows in equation_rows.values():
+        rows.sort()
+
+    precedent_runs = []
+    for run in runs:
+        precedents = set()
+        for target in run:
+            for precedent in get_equation_precedents(target, equation_rows):
+                if precedent in run_of:
+                    precedents.add(run_of[precedent])
+        precedent_runs.append(list(precedents))
+    return precedent_runs
+
+def order_equations(runs: list[list[tuple[int, int]]]) -> tuple[list[list[tuple[int, int]]], set[tuple[int, int]]]:
+    # evaluation order over the runs of equations that need updating, plus the equations in circular references
+    precedent_runs = get_precedent_runs(runs)
+    components = find_strongly_connected_components(precedent_runs)
+    tangled = {
+        i for component in components for i in component
+        if len(component) > 1 or component[0] in precedent_runs[component[0]]
+    }
+
+    # a run can go round through equations outside it without any equation in it referring
+    # back to itself. runs caught up like that are taken apart, so only equations that really
+    # are in a circular reference are marked, and the rest are worked out in order
+    if any(len(runs[i]) > 1 for i in tangled):
+        runs = [run for i, run in enumerate(runs) if i not in tangled] + [[target] for i in tangled for target in runs[i]]
+        precedent_runs = get_precedent_runs(runs)
+        components = find_strongly_connected_components(precedent_runs)
+
+    # precedents come out before the runs that use them
+    order = []
+    cyclic = set()
+    for component in components:
+        # runs in a loop were taken apart above, so each of these is one equation in a circular reference
+        if len(component) > 1 or component[0] in precedent_runs[component[0]]:
+            cyclic.update(runs[i][0] for i in component)
+        order.extend(runs[i] for i in component)
+
+    return order, cyclic
 
 def set_current_cell(last_x: int, last_y: int, return_type: str = '\n'):
     global current_cell
@@ -451,10 +1145,11 @@ def set_current_cell(last_x: int, last_y: int, return_type: str = '\n'):
     elif return_type == '\t':
         x += 1
 
-    current_cell = convert_x_to_alpha_value(x) + str(y)
-    current_value = get_cell(cells, x, y)
-    current_value = '' if current_value == None else current_value
-    set_cell(cells, x, y, current_value)
+    current_cell = convert_x_y_to_cell_name(x, y)
+
+    # make sure the cell exists (without wiping a failed equation's value)
+    if y >= height or x >= width:
+        set_cell(cells, x, y, '')
 
     
 
@@ -467,11 +1162,30 @@ def handle_exit(signum, frame):
     # Re-enable line wrapping
     print("\033[?7h")
 
+    # keep the journal, so the edits can be recovered
+    close_journal()
 
     sys.exit(0)
 signal.signal(signal.SIGINT, handle_exit)
 signal.signal(signal.SIGTERM, handle_exit)
 
+def read_char() -> str:
+    # everything waiting on stdin is read at once, so keys held down can be handled together
+    while len(key_buffer) == 0:
+        # edits still waiting to be synced are synced once no key comes in time
+        if journal_unsynced:
+            wait = journal_synced + JOURNAL_SYNC_SECONDS - time.monotonic()
+            if wait <= 0 or len(select.select([sys.stdin], [], [], wait)[0]) == 0:
+                sync_journal()
+        data = os.read(sys.stdin.fileno(), 4096)
+        if data == b'':
+            return ''
+        key_buffer.extend(key_decoder.decode(data))
+    return key_buffer.popleft()
+
+def key_pending() -> bool:
+    return len(key_buffer) > 0 or len(select.select([sys.stdin], [], [], 0)[0]) > 0
+
 def input_f():
     global command_stack, old_settings, fd, current_cell
 
@@ -486,9 +1200,9 @@ def input_f():
     else:
         # set chars to current value
         x, y = convert_cell_name_to_x_y(current_cell)
-        current_value = get_cell(cells, x, y)
-        if current_cell in equations:
-            current_value = equations[current_cell]
+        current_value = format_cell_value(get_cell(cells, x, y))
+        if (x, y) in equations:
+            current_value = convert_template_to_equation(equations[(x, y)], x, y)
         if current_value == None: current_value = ''
         chars = list(current_value)
 
@@ -511,7 +1225,7 @@ def input_f():
         tty.setraw(sys.stdin.fileno())
 
         while ch != '\n' and ch != '\r':
-            ch = sys.stdin.read(1)
+            ch = read_char()
             if ch == '\n' or ch == '\r':
                 return_type = '\n'
                 break
@@ -543,13 +1257,13 @@ def input_f():
                         chars = chars[:cursor_pos] + [ch] + chars[cursor_pos:]
                     cursor_pos += 1
             elif escaped:
-                ch = sys.stdin.read(1)
+                ch = read_char()
 
                 # check for shifts
                 if ch != 'D' and ch != 'C' and ch != 'A' and ch != 'B':
-                    ch = sys.stdin.read(1)
-                    ch = sys.stdin.read(1)
-                    ch = sys.stdin.read(1)
+                    ch = read_char()
+                    ch = read_char()
+                    ch = read_char()
                     return_type = "<SHIFT>"
                 else:
                     return_type = ''
@@ -613,190 +1327,967 @@ def input_f():
 
 
 def TRIM_CELLS():
-    global cells, equations, height, width, current_cell
+    global cells, equations, height, width, current_cell, rebuild_bounds
 
     current_x, current_y = convert_cell_name_to_x_y(current_cell)
-    
-    # find last row and column with data
-    last_y_with_data = len(cells)
-    for y in range(height-1, -1, -1):
-        row_has_data = False
-        for x in range(0, width):
-            cell_name = convert_x_to_alpha_value(x) + str(y)
-            value = get_cell(cells, x, y)
-            if value != '' and value != None:
-                row_has_data = True
-                break
-            elif cell_name in equations:
-                row_has_data = True
-                break
-        if not row_has_data and y < last_y_with_data:
-            last_y_with_data = y
-        else:
-            break
 
-    last_x_with_data = width
-    for x in range(width-1, -1, -1):
-        column_has_data = False
-        for y in range(0, height):
-            cell_name = convert_x_to_alpha_value(x) + str(y)
-            value = get_cell(cells, x, y)
-            if value != '' and value != None:
-                column_has_data = True
-                break
-            elif cell_name in equations:
-                column_has_data = True
-                break
-        if not column_has_data and x < last_x_with_data:
-            last_x_with_data = x
-        else:
-            break
-    
-    last_y_with_data = max(last_y_with_data, current_y+1)
-    last_x_with_data = max(last_x_with_data, current_x+1)
+    # count everything once, after that the counts follow each change
+    if rebuild_bounds:
+        row_counts.clear()
+        column_counts.clear()
+        del used_rows[:]
+        del used_columns[:]
+        for y, row in cells.items():
+            for x in row:
+                count_cell(x, y, 1)
+        for x, y in equations:
+            count_cell(x, y, 1)
+        rebuild_bounds = False
 
-    # remove empty rows or columns
-    cells = cells[:last_y_with_data]
-    for y in range(0, len(cells)):
-        cells[y] = cells[y][:last_x_with_data]
+    # find last row and column with data
+    last_y_with_data = last_occupied(row_counts, used_rows)
+    last_x_with_data = last_occupied(column_counts, used_columns)
 
+    # rows of a mapped file count unless they've been emptied
+    last_mapped_y = len(row_starts) - 1
+    while last_mapped_y >= 0 and cells.get(last_mapped_y) == {}:
+        last_mapped_y -= 1
+    if last_mapped_y >= 0:
+        last_y_with_data = max(last_y_with_data, last_mapped_y+1)
+        last_x_with_data = max(last_x_with_data, mapped_width)
 
-    # remove equation references
-    if last_y_with_data != height:
-        for y in range(last_y_with_data, height):
-            for x in range(0, width):
-                cell_name = convert_x_to_alpha_value(x) + str(y)
-                if cell_name in equations: del equations[cell_name]
+    last_y_with_data = max(last_y_with_data, current_y+1)
+    last_x_with_data = max(last_x_with_data, current_x+1)
 
-    if last_x_with_data != width:
-        for x in range(last_x_with_data, width):
-            for y in range(0, height):
-                cell_name = convert_x_to_alpha_value(x) + str(y)
-                if cell_name in equations: del equations[cell_name]
-    
     # set new widths and heights
     width = last_x_with_data
     height = last_y_with_data
 
+def get_column_prefix_sums(x: int) -> tuple[list[int], int, list[int]]:
+    # running totals down a column, plus a running count of cells that can't be summed. the totals
+    # are exact, as whole numbers of 1/scale, so a big number above a range can't swamp what's in it
+    if x in column_prefix_sums:
+        return column_prefix_sums[x]
+
+    values = []
+    failures = [0]
+    failed = 0
+    for y in range(height):
+        row = get_row(y)
+        value = '' if row == None else row.get(x, '')
+        if not isinstance(value, float):
+            if value == None:
+                value = math.nan
+            elif value == '':
+                value = 0.0
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = math.nan
+        if not math.isfinite(value):
+            failed += 1
+            value = 0.0
+        values.append(value.as_integer_ratio())
+        failures.append(failed)
+
+    # every denominator is a power of two, so they all divide the biggest
+    scale = max((denominator for numerator, denominator in values), default=1)
+    sums = [0]
+    total = 0
+    for numerator, denominator in values:
+        total += numerator * (scale // denominator)
+        sums.append(total)
+
+    column_prefix_sums[x] = (sums, scale, failures)
+    return sums, scale, failures
+
+def sum_cell_range(startx: int, starty: int, endx: int, endy: int) -> tuple[bool, float]:
+    if startx < 0 or starty < 0:
+        return True, 0.0
+    total = 0
+    scale = 1
+    for x in range(startx, endx+1):
+        sums, column_scale, failures = get_column_prefix_sums(x)
+        last = len(sums) - 1
+        top = min(starty, last)
+        bottom = min(endy+1, last)
+        if failures[bottom] - failures[top] > 0:
+            return True, 0.0
+
+        # the columns are added up exactly too, and only rounded once at the end
+        if column_scale > scale:
+            total *= column_scale // scale
+            scale = column_scale
+        total += (sums[bottom] - sums[top]) * (scale // column_scale)
 
-    # make default spreadsheet if empty
-    if width == height == 0:
-        cells = [['']]
-        width = 1
-        height = 1
-
-def APPLY_EQUATIONS():
-    global cells, equations, width, height, operators, functions
+    try:
+        return False, total / scale
+    except OverflowError:
+        return False, math.inf if total > 0 else -math.inf
+
+def get_lookup_key(value):
+    # numbers match however they're written, text matches exactly. empty cells and errors match nothing
+    if value == None or value == '':
+        return None
+    if isinstance(value, float):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def get_cell_key(x: int, y: int):
+    if x < 0 or y < 0:
+        return None
+    return get_lookup_key(get_cell(cells, x, y))
+
+def get_column_index(x: int) -> dict:
+    if x in column_indexes:
+        return column_indexes[x]
+
+    index = {}
+    for y in range(height):
+        row = get_row(y)
+        key = None if row == None else get_lookup_key(row.get(x))
+        if key != None:
+            if key not in index:
+                index[key] = []
+            index[key].append(y)
+
+    column_indexes[x] = index
+    return index
+
+def find_key_rows(key, x: int, starty: int, endy: int) -> list[int]:
+    # rows between starty and endy where column x holds key
+    if key == None or x < 0 or starty < 0:
+        return []
+    rows = get_column_index(x).get(key, [])
+    return rows[bisect.bisect_left(rows, starty):bisect.bisect_right(rows, endy)]
+
+def vlookup(key, cell_range: tuple, column: float):
+    # the value in the given column (from 1) of the first row whose first column holds key
+    startx, starty, endx, endy = cell_range
+    rows = find_key_rows(key, startx, starty, endy)
+    if not isinstance(column, float) or not math.isfinite(column):
+        return VALUE_ERROR
+    column = int(column) - 1
+    if not 0 <= column <= endx - startx:
+        return VALUE_ERROR
+    if len(rows) == 0:
+        return NA_ERROR
+    return get_cell_operand(startx + column, rows[0])
+
+def match(key, cell_range: tuple):
+    # position (from 1) of the first row whose first column holds key
+    startx, starty, endx, endy = cell_range
+    rows = find_key_rows(key, startx, starty, endy)
+    return NA_ERROR if len(rows) == 0 else float(rows[0] - starty + 1)
+
+def countif(cell_range: tuple, key):
+    startx, starty, endx, endy = cell_range
+    return float(sum(len(find_key_rows(key, x, starty, endy)) for x in range(startx, endx+1)))
+
+def sumif(cell_range: tuple, key, sum_range: tuple = None):
+    # cells of sum_range in the same place as the cells of cell_range holding key
+    startx, starty, endx, endy = cell_range
+    sum_startx, sum_starty = (startx, starty) if sum_range == None else sum_range[:2]
+    total = 0.0
+    for x in range(startx, endx+1):
+        for y in find_key_rows(key, x, starty, endy):
+            value = get_cell_operand(sum_startx + x - startx, sum_starty + y - starty)
+            if value.__class__ is str:
+                return value
+            total += value
+    return total
+
+def get_range_numbers(startx: int, starty: int, endx: int, endy: int):
+    # the numbers in a range a row at a time, empty cells are skipped.
+    # text or an error gives None and ends it
+    if startx < 0 or starty < 0:
+        yield None
+        return
+    for y in range(starty, min(endy+1, height)):
+        row = get_row(y)
+        if row == None: continue
+        for x in range(startx, endx+1):
+            value = row.get(x, '')
+            if isinstance(value, float):
+                yield value
+            elif value == None:
+                yield None
+                return
+            elif value != '':
+                try:
+                    yield float(value)
+                except ValueError:
+                    yield None
+                    return
 
-    equation_targets = {}
-    unresolved_equations = equations.copy()
-    last_size = len(unresolved_equations) + 1
-    while last_size > len(unresolved_equations):
-        last_size = len(unresolved_equations)
-        current_unresolved_equations = {}
-        for target, equation in unresolved_equations.items():
+def remember_statistics(key: tuple, result):
+    kind, startx, starty, endx, endy = key
+    range_statistics[key] = result
+    for x in range(startx, endx+1):
+        if x not in statistics_columns:
+            statistics_columns[x] = set()
+        statistics_columns[x].add(key)
+
+def get_range_statistics(cell_range: tuple) -> tuple:
+    # count, minimum, maximum, mean and the sum of squared differences from the mean,
+    # in one pass (welford's algorithm). None if the range can't be used
+    key = ('statistics',) + cell_range
+    if key in range_statistics:
+        return range_statistics[key]
+
+    count = 0
+    minimum = math.inf
+    maximum = -math.inf
+    mean = 0.0
+    m2 = 0.0
+    statistics = None
+    for value in get_range_numbers(*cell_range):
+        if value == None:
+            break
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+        if value < minimum: minimum = value
+        if value > maximum: maximum = value
+    else:
+        statistics = (count, minimum, maximum, mean, m2)
+
+    remember_statistics(key, statistics)
+    return statistics
+
+def combine_statistics(first: tuple, second: tuple) -> tuple:
+    if first[0] == 0: return second
+    if second[0] == 0: return first
+
+    count = first[0] + second[0]
+    delta = second[3] - first[3]
+    mean = first[3] + delta * second[0] / count
+    m2 = first[4] + second[4] + delta * delta * first[0] * second[0] / count
+    return count, min(first[1], second[1]), max(first[2], second[2]), mean, m2
+
+def get_statistics(arguments: tuple) -> tuple:
+    # arguments are ranges, numbers or what a cell holds. empty cells are skipped
+    statistics = (0, math.inf, -math.inf, 0.0, 0.0)
+    for argument in arguments:
+        if isinstance(argument, tuple):
+            argument_statistics = get_range_statistics(argument)
+        elif isinstance(argument, float):
+            argument_statistics = (1, argument, argument, argument, 0.0)
+        elif argument == None:
+            continue
+        else:
+            return None
+
+        if argument_statistics == None:
+            return None
+        statistics = combine_statistics(statistics, argument_statistics)
+
+    return statistics
+
+def select_value(values: list[float], k: int) -> float:
+    # k-th smallest value (from 0). only the side of each partition holding it is kept, so it's linear on average
+    while True:
+        pivot = values[len(values) // 2]
+        lower = [value for value in values if value < pivot]
+        if k < len(lower):
+            values = lower
+            continue
+        equal = sum(1 for value in values if value == pivot)
+        if k < len(lower) + equal:
+            return pivot
+        k -= len(lower) + equal
+        values = [value for value in values if value > pivot]
+
+def get_range_median(cell_range: tuple):
+    key = ('median',) + cell_range
+    if key in range_statistics:
+        return range_statistics[key]
+
+    values = list(get_range_numbers(*cell_range))
+    median = None
+    if len(values) > 0 and values[-1] != None:
+        middle = len(values) // 2
+        median = select_value(values, middle)
+        if len(values) % 2 == 0:
+            median = (median + select_value(values, middle - 1)) / 2
+
+    remember_statistics(key, median)
+    return median
+
+def range_min(*arguments):
+    statistics = get_statistics(arguments)
+    return None if statistics == None or statistics[0] == 0 else statistics[1]
+
+def range_max(*arguments):
+    statistics = get_statistics(arguments)
+    return None if statistics == None or statistics[0] == 0 else statistics[2]
+
+def range_count(*arguments):
+    statistics = get_statistics(arguments)
+    return None if statistics == None else float(statistics[0])
+
+def range_var(*arguments):
+    # sample variance
+    statistics = get_statistics(arguments)
+    return None if statistics == None or statistics[0] < 2 else statistics[4] / (statistics[0] - 1)
+
+def range_stdev(*arguments):
+    variance = range_var(*arguments)
+    return None if variance == None else math.sqrt(variance)
+
+def range_median(*arguments):
+    if len(arguments) == 1 and isinstance(arguments[0], tuple):
+        return get_range_median(arguments[0])
+
+    values = []
+    for argument in arguments:
+        if isinstance(argument, tuple):
+            values.extend(get_range_numbers(*argument))
+        elif argument != None:
+            values.append(argument)
+    if len(values) == 0 or not all(isinstance(value, float) for value in values):
+        return None
+
+    middle = len(values) // 2
+    median = select_value(values, middle)
+    if len(values) % 2 == 0:
+        median = (median + select_value(values, middle - 1)) / 2
+    return median
+
+lookup_functions = {
+    'vlookup': vlookup,
+    'match': match,
+    'countif': countif,
+    'sumif': sumif,
+}
+# which arguments of a lookup are ranges, by how many arguments it's given
+lookup_arguments = {
+    'vlookup': {3: [False, True, False]},
+    'match': {2: [False, True]},
+    'countif': {2: [True, False]},
+    'sumif': {2: [True, False], 3: [True, False, True]},
+}
+aggregate_functions = {
+    'min': range_min,
+    'max': range_max,
+    'count': range_count,
+    'median': range_median,
+    'stdev': range_stdev,
+    'var': range_var,
+}
+range_functions = {**lookup_functions, **aggregate_functions}
+
+def assemble_load(instruction: int, offset: tuple):
+    # cells are only read when the equation at (x, y) gets to them
+    if instruction == LOAD_CELL:
+        offset_x, offset_y = offset
+        return lambda x, y: get_cell_operand(x + offset_x, y + offset_y)
+    if len(offset) == 2:
+        offset_x, offset_y = offset
+        return lambda x, y: get_cell_key(x + offset_x, y + offset_y)
+
+    startx, starty, endx, endy = offset
+    if instruction == LOAD_TOTAL:
+        return lambda x, y: get_range_total(x + startx, y + starty, x + endx, y + endy)
+    return lambda x, y: (x + startx, y + starty, x + endx, y + endy)
+
+def assemble_branch_load(instruction: int, offset: tuple):
+    # loads inside a branch note what they read, so only the branches taken become dependencies
+    load = assemble_load(instruction, offset)
+    if len(offset) == 2:
+        offset_x, offset_y = offset
+        def load_branch(x, y):
+            branch_reads.append((x + offset_x, y + offset_y))
+            return load(x, y)
+        return load_branch
+
+    startx, starty, endx, endy = offset
+    def load_branch(x, y):
+        branch_reads.append((x + startx, y + starty, x + endx, y + endy))
+        return load(x, y)
+    return load_branch
+
+def assemble_instruction(instruction: int, argument, operands: list, function_table: dict):
+    # each instruction becomes a closure that works out its operands, then itself.
+    # errors are returned like any other value and carried through whatever uses
+    # them, so bad cells don't raise. the values can be numpy arrays too
+    if instruction == PUSH:
+        return lambda x, y: argument
+
+    if instruction == NEGATE:
+        operand, = operands
+        def negate(x, y):
+            value = operand(x, y)
+            return value if value.__class__ is str else -value
+        return negate
+
+    if instruction == CALL:
+        name, count = argument
+        if name == 'if':
+            condition, taken = operands[:2]
+            otherwise = operands[2] if count == 3 else lambda x, y: 0.0
+            def branch(x, y):
+                value = condition(x, y)
+                if value.__class__ is str:
+                    return value
+                return taken(x, y) if value != 0.0 else otherwise(x, y)
+            return branch
+
+        if name in {'and', 'or'}:
+            # stops at the first argument that decides it
+            deciding = 0.0 if name == 'and' else 1.0
+            def all_or_any(x, y):
+                for operand in operands:
+                    value = operand(x, y)
+                    if value.__class__ is str:
+                        return value
+                    if (value != 0.0) == (deciding != 0.0):
+                        return deciding
+                return 1.0 - deciding
+            return all_or_any
+
+        if name == 'iferror':
+            first, fallback = operands
+            def if_error(x, y):
+                value = first(x, y)
+                # infinite results only become errors once stored, so they're caught here too
+                if value.__class__ is str or not math.isfinite(value):
+                    return fallback(x, y)
+                return value
+            return if_error
+
+        if name in range_functions:
+            range_function = range_functions[name]
+            def call_range_function(x, y):
+                values = [operand(x, y) for operand in operands]
+                # lookups can be given text, but not errors
+                for value in values:
+                    if value.__class__ is str and value in error_values:
+                        return value
+                try:
+                    result = range_function(*values)
+                except (TypeError, ValueError, IndexError):
+                    return VALUE_ERROR
+                return VALUE_ERROR if result is None else result
+            return call_range_function
+
+        function = function_table[name]
+        def call_function(x, y):
+            values = []
+            for operand in operands:
+                value = operand(x, y)
+                if value.__class__ is str:
+                    return value
+                values.append(value)
+            try:
+                return function(*values)
+            except (ValueError, TypeError, OverflowError, ZeroDivisionError):
+                # e.g. sqrt(-1)
+                return VALUE_ERROR
+        return call_function
+
+    left, right = operands
+    if instruction in {DIVIDE, FLOOR_DIVIDE}:
+        divide = operator.truediv if instruction == DIVIDE else operator.floordiv
+        def divide_operands(x, y):
+            first = left(x, y)
+            if first.__class__ is str:
+                return first
+            second = right(x, y)
+            if second.__class__ is str:
+                return second
+            if second.__class__ is float and second == 0.0:
+                return DIV_ZERO_ERROR
+            return divide(first, second)
+        return divide_operands
+
+    if instruction == POWER:
+        def power(x, y):
+            first = left(x, y)
+            if first.__class__ is str:
+                return first
+            second = right(x, y)
+            if second.__class__ is str:
+                return second
+            if first.__class__ is float and first == 0.0 and second.__class__ is float and second < 0.0:
+                return DIV_ZERO_ERROR
+            try:
+                result = first ** second
+            except OverflowError:
+                return VALUE_ERROR
+            # e.g. (-1)**0.5
+            return VALUE_ERROR if result.__class__ is complex else result
+        return power
+
+    if instruction in comparison_operations:
+        comparison = comparison_operations[instruction]
+        def compare(x, y):
+            first = left(x, y)
+            if first.__class__ is str:
+                return first
+            second = right(x, y)
+            if second.__class__ is str:
+                return second
+            # 1.0 or 0.0, for numbers and numpy arrays alike
+            return comparison(first, second) * 1.0
+        return compare
+
+    operation = binary_operations[instruction]
+    def operate(x, y):
+        first = left(x, y)
+        if first.__class__ is str:
+            return first
+        second = right(x, y)
+        if second.__class__ is str:
+            return second
+        return operation(first, second)
+    return operate
+
+def assemble_program(program: list, function_table: dict, load):
+    # the postfix program is put together into closures once, which is much quicker
+    # to run than going around a dispatch loop for every instruction
+    stack = []
+    for instruction, argument in program:
+        if instruction in {LOAD_CELL, LOAD_TOTAL, LOAD_ARGUMENT}:
+            stack.append(load(instruction, argument))
+            continue
+
+        if instruction == PUSH:
+            count = 0
+        elif instruction == NEGATE:
+            count = 1
+        elif instruction == CALL:
+            count = argument[1]
+        else:
+            count = 2
+        operands = stack[len(stack)-count:]
+        del stack[len(stack)-count:]
+        stack.append(assemble_instruction(instruction, argument, operands, function_table))
+
+    return stack[-1]
+
+def check_resolution(resolution):
+    # only real, finite numbers can be stored (e.g. not 1e308*10), errors are kept as they are
+    if resolution.__class__ is float:
+        return resolution if math.isfinite(resolution) else VALUE_ERROR
+    if resolution.__class__ is str:
+        return resolution
+    return VALUE_ERROR
+
+def get_range_total(startx: int, starty: int, endx: int, endy: int):
+    if startx < 0 or starty < 0:
+        return REF_ERROR
+    failed_to_subsitute, total = sum_cell_range(startx, starty, endx, endy)
+    return VALUE_ERROR if failed_to_subsitute else total
+
+def assemble_equation(template: str):
+    program, source, offsets, range_offsets, lookups, branches = compile_equation(template)
+    if program == None:
+        evaluate = lambda x, y: VALUE_ERROR
+    else:
+        loaded = {LOAD_CELL: offsets, LOAD_TOTAL: range_offsets, LOAD_ARGUMENT: lookups}
+        branches = branches or set()
+        evaluate = assemble_program(
+            program,
+            math_functions,
+            lambda instruction, index: (
+                assemble_branch_load if (instruction, index) in branches else assemble_load
+            )(instruction, loaded[instruction][index])
+        )
+    assembled_programs[template] = evaluate
+    return evaluate
+
+def evaluate_equation(target: tuple[int, int]):
+    template = equations[target]
+    evaluate = assembled_programs.get(template)
+    if evaluate == None:
+        evaluate = assemble_equation(template)
+    return check_resolution(evaluate(*target))
+
+def get_fill_down_key(target: tuple[int, int]) -> tuple:
+    # equations copied down a column share their source and their offsets to what they reference
+    program, source, offsets, range_offsets, lookups, branches = compile_equation(equations[target])
+    return source, target[0], tuple(offsets), tuple(range_offsets), tuple(lookups), branches != None
+
+def find_fill_down_runs(targets: set[tuple[int, int]]) -> list[list[tuple[int, int]]]:
+    # group equations into runs that can be evaluated in one batch, everything else is a run of one
+    keyed_targets = {}
+    for target in targets:
+        key = get_fill_down_key(target)
+        if key not in keyed_targets:
+            keyed_targets[key] = []
+        keyed_targets[key].append((target[1], target))
+
+    runs = []
+    for (source, x, offsets, range_offsets, lookups, branching), rows in keyed_targets.items():
+        rows.sort()
+        start = 0
+        for i in range(1, len(rows)+1):
+            if i < len(rows) and rows[i][0] == rows[i-1][0] + 1:
+                continue
+
+            run = [target for y, target in rows[start:i]]
+            start = i
+
+            # members of a run can't depend on each other
+            depends_on_run = any(offset_x == 0 and abs(offset_y) < len(run) for offset_x, offset_y in offsets)
+            depends_on_run = depends_on_run or any(startx <= 0 <= endx for startx, starty, endx, endy in range_offsets)
+
+            # functions given ranges work a cell at a time, and so do branches
+            if len(run) < MIN_FILL_DOWN_RUN or depends_on_run or len(lookups) > 0 or branching:
+                runs.extend([target] for target in run)
+            else:
+                runs.append(run)
+
+    return runs
+
+def evaluate_fill_down_run(run: list[tuple[int, int]]) -> list:
+    program, source, offsets, range_offsets, lookups, branches = compile_equation(equations[run[0]])
+    if program == None or numpy == None:
+        return [evaluate_equation(target) for target in run]
+
+    x, first_y = run[0]
+    rows = range(first_y, first_y + len(run))
+
+    # gather each input as a column of values. rows with an error in them are worked out on their own
+    redo = [False] * len(run)
+    cell_columns = []
+    for offset_x, offset_y in offsets:
+        column = [get_cell_operand(x + offset_x, y + offset_y) for y in rows]
+        for row, value in enumerate(column):
+            if value.__class__ is str:
+                redo[row] = True
+                column[row] = 0.0
+        cell_columns.append(numpy.array(column, dtype=float))
+
+    total_columns = []
+    for startx, starty, endx, endy in range_offsets:
+        column = [get_range_total(x + startx, y + starty, x + endx, y + endy) for y in rows]
+        for row, value in enumerate(column):
+            if value.__class__ is str:
+                redo[row] = True
+                column[row] = 0.0
+        total_columns.append(numpy.array(column, dtype=float))
 
-            failed_to_subsitute = False
-            tokens = tokenize_equation(equation)
+    try:
+        with numpy.errstate(all='ignore'):
+            columns = {LOAD_CELL: cell_columns, LOAD_TOTAL: total_columns}
+            evaluate = assemble_program(
+                program,
+                vector_math_functions,
+                lambda instruction, index: (lambda x, y, column=columns[instruction][index]: column)
+            )
+            resolutions = evaluate(x, first_y)
+            resolutions = numpy.broadcast_to(numpy.asarray(resolutions, dtype=float), len(run))
+            finite = numpy.isfinite(resolutions).tolist()
+    except (ValueError, TypeError, OverflowError, ZeroDivisionError):
+        # fall back to evaluating row by row
+        return [evaluate_equation(target) for target in run]
+
+    # rows that came out infinite or nan are worked out again, to find which error they are
+    return [
+        resolution if finite[row] and not redo[row] else evaluate_equation(run[row])
+        for row, resolution in enumerate(resolutions.tolist())
+    ]
 
-            substituted_equation = []
-            # a3=sum(a1:a2)
-            i = 0
-            while i < len(tokens):
-                token = tokens[i]
-                if token not in operators:
-                    if token in {'sum', 'avg'}:
-                        cell_range = tokens[i+2] + tokens[i+3] + tokens[i+4]
-                        target_cells = convert_cell_range_to_targets(cell_range)
-                        target_cell_names = [convert_x_to_alpha_value(x) + str(y) for x, y in target_cells]
-
-                        new_tokens = tokens[:i]
-                        new_tokens.append('(')
-                        for target_cell_name in target_cell_names:
-                            new_tokens.append(target_cell_name)
-                            new_tokens.append("+")
-                        new_tokens[-1] = ')'
-                        if token == 'avg': 
-                            new_tokens.append('/')
-                            new_tokens.append(str(len(target_cell_names)))
-                        if i+6 < len(tokens): new_tokens.append(token[i+6:])
-                        tokens = new_tokens
-                        i-=1
-                    else:
-                        if token in math_functions:
-                            substituted_equation.append(token)
-                        else:
-                            failed_to_subsitute, float_value = substitute_if_ref(token, equation_targets)
-                            if failed_to_subsitute: break
-                            substituted_equation.append(str(float_value))
-                else:
-                    substituted_equation.append(token)
-                i+=1
+def APPLY_EQUATIONS():
+    global cells, equations, width, height, operators, functions, rebuild_dependencies
+
+    # update the dependency graph and find which equations need recalculating
+    if rebuild_dependencies:
+        equation_references.clear()
+        equation_ranges.clear()
+        equation_dependents.clear()
+        range_columns.clear()
+        column_prefix_sums.clear()
+        column_indexes.clear()
+        range_statistics.clear()
+        statistics_columns.clear()
+        live_templates = set(equations.values())
+        for template in [template for template in compiled_equations if template not in live_templates]:
+            del compiled_equations[template]
+        assembled_programs.clear()
+
+        # the branches equations took are kept, so working everything out again
+        # starts from the same dependencies as an update would
+        for target in list(equation_branch_reads):
+            if target not in equations or target in dirty_equations:
+                del equation_branch_reads[target]
+        for target in equations:
+            add_equation_dependencies(target)
+        targets = set(equations.keys())
+        rebuild_dependencies = False
+    elif len(dirty_cells) == 0 and len(dirty_equations) == 0:
+        # nothing changed, so nothing needs working out
+        targets = set()
+    else:
+        for target in dirty_equations:
+            remove_equation_dependencies(target)
+            equation_branch_reads.pop(target, None)
+            if target in equations:
+                add_equation_dependencies(target)
+        targets = find_dependent_equations(dirty_cells | dirty_equations)
+        targets |= dirty_equations
+
+        # equations whose result was written over from outside
+        targets |= dirty_cells
+        targets = {target for target in targets if target in equations}
+
+    dirty_cells.clear()
+    dirty_equations.clear()
+
+    rerun = False
+    rechecked = set()
+    while len(targets) > 0:
+        order, cyclic = order_equations(find_fill_down_runs(targets))
+
+        # equations not worked out yet this pass
+        pending = set(targets)
+        pending_rows = {}
+        for x, y in targets:
+            if x not in pending_rows:
+                pending_rows[x] = []
+            pending_rows[x].append(y)
+        for rows in pending_rows.values():
+            rows.sort()
+
+        stale = set()
+        for run in order:
+            if len(run) == 1 and run[0] in cyclic:
+                resolutions = [CYCLE_ERROR]
+            elif len(run) == 1:
+                target = run[0]
+                branch_reads.clear()
+                resolutions = [evaluate_equation(target)]
+                program, source, offsets, range_offsets, lookups, branches = compile_equation(equations[target])
+                if branches != None:
+                    if reads_pending_equations(branch_reads, pending, pending_rows):
+                        stale.add(target)
+                    set_branch_reads(target, branch_reads, rerun)
+            else:
+                resolutions = evaluate_fill_down_run(run)
 
-            resolution = 0.0
-            if not failed_to_subsitute:
-                substituted_equation = ''.join(substituted_equation)
-                try:
-                    resolution = eval(substituted_equation, {"__builtins__": {}}, math_functions)
-                except Exception as e:
-                    # nothing
-                    resolution = None
-                equation_targets[target] = resolution
-                x, y = convert_cell_name_to_x_y(target)
+            pending.difference_update(run)
+            for (x, y), resolution in zip(run, resolutions):
                 set_cell(cells, x, y, resolution)
-            else:
-                current_unresolved_equations[target] = equation
 
-        unresolved_equations = current_unresolved_equations
+        # a branch that switched over read equations before they were worked out. they're its
+        # dependencies now, so it and everything downstream of it are worked out again after them.
+        # a circular reference through a branch may have been read from values that weren't
+        # worked out yet either, so those equations get one more look at which branch they take
+        recheck = {target for target in cyclic if target in equation_branch_reads and target not in rechecked}
+        for target in recheck:
+            set_branch_reads(target, [])
+        rechecked |= recheck
+        targets = stale | recheck | find_dependent_equations(stale | recheck)
+        rerun = True
+
+    # results were written in dependency order, so nothing downstream is stale
+    dirty_cells.clear()
+
+    write_journal()
+
+def build_fenwick_tree(values: list[int]) -> list[int]:
+    tree = [0] + values
+    for i in range(1, len(tree)):
+        parent = i + (i & -i)
+        if parent < len(tree):
+            tree[parent] += tree[i]
+    return tree
+
+def add_to_fenwick_tree(tree: list[int], i: int, delta: int):
+    i += 1
+    while i < len(tree):
+        tree[i] += delta
+        i += i & -i
+
+def sum_fenwick_tree(tree: list[int], count: int) -> int:
+    # total of the first count values
+    total = 0
+    while count > 0:
+        total += tree[count]
+        count -= count & -count
+    return total
+
+def search_fenwick_tree(tree: list[int], total: int) -> int:
+    # how many values from the start add up to no more than total
+    count = 0
+    step = 1 << len(tree).bit_length()
+    while step > 0:
+        if count + step < len(tree) and tree[count + step] <= total:
+            count += step
+            total -= tree[count]
+        step >>= 1
+    return count
+
+def measure_cell(x: int, y: int) -> tuple[int, int]:
+    # width and lines a cell takes on screen. empty cells measure (0, 1) and don't count
+    row = get_row(y)
+    value = '' if row == None else row.get(x, '')
+    if layout_equations and (x, y) in equations:
+        value = get_equation(x, y)
+
+    if (x, y) in wrapped_cells:
+        if value == None: return 0, 1
+        return WRAP_WIDTH, len(wrap(WRAP_WIDTH, format_cell_value(value)).split('\n'))
+    return len(format_cell_value(value)) if value != None else len('Error'), 1
+
+def count_cell_layout(x: int, y: int, layout: tuple[int, int], count: int):
+    cell_width, lines = layout
+    if cell_width > 0:
+        widths = column_cell_widths.setdefault(x, collections.Counter())
+        widths[cell_width] += count
+        if widths[cell_width] == 0:
+            del widths[cell_width]
+    if lines > 1:
+        row_lines = row_cell_lines.setdefault(y, collections.Counter())
+        row_lines[lines] += count
+        if row_lines[lines] == 0:
+            del row_lines[lines]
+
+def note_layout_change(target: tuple[int, int]):
+    # cells are measured again on the next DISPLAY, against how they measured before their first change
+    if not rebuild_layout and target not in layout_changes:
+        layout_changes[target] = measure_cell(*target)
+
+def update_column_width(x: int):
+    widths = column_cell_widths.get(x)
+    column_width = max(4, max(widths)) if widths else 4
+    if column_width != column_widths[x]:
+        add_to_fenwick_tree(column_tree, x, column_width - column_widths[x])
+        column_widths[x] = column_width
+
+def update_row_height(y: int):
+    row_lines = row_cell_lines.get(y)
+    row_height = max(row_lines) if row_lines else 1
+    if row_height != row_heights[y]:
+        add_to_fenwick_tree(row_tree, y, row_height - row_heights[y])
+        row_heights[y] = row_height
+
+def update_layout(show_equations: bool):
+    global column_tree, row_tree, layout_equations, rebuild_layout
+
+    if rebuild_layout:
+        # measure every cell once, after that only changed cells are measured
+        column_cell_widths.clear()
+        row_cell_lines.clear()
+        layout_changes.clear()
+        layout_equations = show_equations
+        shown_equations = equations if show_equations else {}
+        for y in range(height):
+            row = get_row(y)
+            if row == None: continue
+            for x, value in row.items():
+                if (x, y) in wrapped_cells or (x, y) in shown_equations: continue
+                widths = column_cell_widths.setdefault(x, collections.Counter())
+                widths[len(format_cell_value(value)) if value != None else len('Error')] += 1
+        for x, y in wrapped_cells | shown_equations.keys():
+            count_cell_layout(x, y, measure_cell(x, y), 1)
+
+        del column_widths[:]
+        del row_heights[:]
+        column_tree = []
+        row_tree = []
+        rebuild_layout = False
+
+    touched = list(layout_changes)
+    for (x, y), layout in layout_changes.items():
+        count_cell_layout(x, y, layout, -1)
+        count_cell_layout(x, y, measure_cell(x, y), 1)
+    layout_changes.clear()
+
+    # equation cells measure differently when their equations are shown
+    if show_equations != layout_equations:
+        touched.extend(equations)
+        for x, y in equations:
+            count_cell_layout(x, y, measure_cell(x, y), -1)
+        layout_equations = show_equations
+        for x, y in equations:
+            count_cell_layout(x, y, measure_cell(x, y), 1)
+
+    # grow the trees to fit the sheet, doubling so they're rarely rebuilt
+    if len(column_widths) < width:
+        column_widths.extend([4] * (max(width, 2 * len(column_widths)) - len(column_widths)))
+        for x in column_cell_widths:
+            if x < len(column_widths):
+                column_widths[x] = max(4, max(column_cell_widths[x] or [0]))
+        column_tree = build_fenwick_tree([column_width + 3 for column_width in column_widths])
+    if len(row_heights) < height:
+        row_heights.extend([1] * (max(height, 2 * len(row_heights)) - len(row_heights)))
+        for y in row_cell_lines:
+            if y < len(row_heights):
+                row_heights[y] = max(row_cell_lines[y] or [1])
+        row_tree = build_fenwick_tree(list(row_heights))
+
+    for x, y in touched:
+        if x < len(column_widths):
+            update_column_width(x)
+        if y < len(row_heights):
+            update_row_height(y)
+
+def draw_screen(lines: list[str], size: os.terminal_size):
+    global screen_size
+
+    # only lines that changed since the last frame are written, all in one go
+    output = []
+    if len(screen_lines) == 0 or size != screen_size:
+        output.append("\033[3J\033[2J")
+        screen_lines.clear()
+    for i, line in enumerate(lines):
+        if i >= len(screen_lines) or line != screen_lines[i]:
+            output.append(f"\033[{i+1};1H{line}\033[K")
+
+    # clear the prompt and whatever is left below the frame
+    output.append(f"\033[{len(lines)+1};1H\033[J")
+    sys.stdout.write(''.join(output))
+    sys.stdout.flush()
 
-    # add missing cells
-    for y in range(len(cells)):
-        while len(cells[y]) < width:
-            cells[y].append('')
+    screen_lines[:] = lines
+    screen_size = size
 
 def DISPLAY(show_equations=False):
     global cells, width, height, current_cell, colors
 
-    # clear screen
-    print("\033[3J\033[2J\033[H", "")
-    sys.stdout.flush()
+    update_layout(show_equations)
 
-    # determine wrap properties
+    # work out what fits on screen first, so only visible cells are formatted
+    size = shutil.get_terminal_size()
+    terminal_width = size.columns
+    terminal_height = size.lines
+    row_label_space = len(str(height))
+    current_x, current_y = convert_cell_name_to_x_y(current_cell)
 
-    column_widths = {i: 4 for i in range(width)}
-    row_heights = {i: 1 for i in range(height)}
-
-    for cell_name in wrapped_cell_names:
-        x, y = convert_cell_name_to_x_y(cell_name)
-        value = get_cell(cells, x, y)
-        if show_equations:
-            equation = get_equation(x, y)
-            if equation != None: value = equation
-
-        if value != None:
-            column_widths[x] = WRAP_WIDTH
-            val_lines = len(wrap(WRAP_WIDTH, value).split('\n'))
-            if val_lines > row_heights[y]:
-                row_heights[y] = val_lines
-
-    for y, row in enumerate(cells):
-        for x, value in enumerate(row):
-            cell_name = convert_x_to_alpha_value(x) + str(y)
-            if cell_name not in wrapped_cell_names:
-                if show_equations:
-                    equation = get_equation(x, y)
-                    if equation != None: value = equation
-                val_len = len(str(value)) if value != None else len(str('Error'))
-                if val_len > column_widths[x]:
-                    column_widths[x] = val_len
-                
+    # skip columns from the left until the current cell fits
+    current_cell_terminal_x = sum_fenwick_tree(column_tree, current_x+1) + row_label_space+2
+    x_adjustment = current_cell_terminal_x - terminal_width
+    first_x = 0
+    if x_adjustment > 0:
+        first_x = search_fenwick_tree(column_tree, x_adjustment-1) + 1
+    last_x = first_x
+    line_width = row_label_space+3
+    while last_x < width and line_width < terminal_width:
+        line_width += column_widths[last_x]+3
+        last_x+=1
+
+    # skip lines from the top until the current cell fits
+    current_cell_terminal_y = sum_fenwick_tree(row_tree, current_y+1) + 3
+    y_adjustment = current_cell_terminal_y - terminal_height
+    # the skipped lines are turned into the row they end in, and how far into it they go
+    lines_skipped = max(y_adjustment-1, 0)
+    first_y = min(search_fenwick_tree(row_tree, lines_skipped), height)
+    lines_to_skip = lines_skipped - sum_fenwick_tree(row_tree, first_y)
+    lines_left = terminal_height - 2
 
     # column labels
-    display = []
-    row_label_space = len(str(height))
+    display = [' ']
     row_display = []
     row_display.append(print_cadet_grey(' ' * (row_label_space+2) + '|'))
-    for i in range(width):
+    for i in range(first_x, last_x):
         alpha_value = convert_x_to_alpha_value(i)
         spaces = column_widths[i] - len(alpha_value)
         first_spaces = spaces // 2 + 1
@@ -808,7 +2299,6 @@ def DISPLAY(show_equations=False):
     display.append(''.join(row_display))
 
 
-    current_x, current_y = convert_cell_name_to_x_y(current_cell)
     selected_start_x, selected_start_y, selected_end_x, selected_end_y = -1, -1, -1, -1
     if len(selected_cells) == 2 and is_selecting:
         selected_start_x, selected_start_y, selected_end_x, selected_end_y = normalize_cell_range(
@@ -816,12 +2306,43 @@ def DISPLAY(show_equations=False):
         )
 
     # rows
-    for y, row in enumerate(cells):
+    for y in range(first_y, height):
+        if lines_left <= 0: break
+        row = get_row(y) or {}
+
+        # lines of each cell and whether it's a number (numbers are right aligned)
+        row_values = []
+        for x in range(first_x, last_x):
+            value = row.get(x, '')
+
+            if show_equations:
+                equation = get_equation(x, y)
+                if equation != None: value = equation
+
+            is_number = isinstance(value, float)
+            if value != None:
+                value = format_cell_value(value)
+                if not is_number:
+                    try:
+                        float(value)
+                        is_number = True
+                    except ValueError:
+                        pass
+
+                if (x, y) in wrapped_cells:
+                    lines = wrap(column_widths[x], value).split('\n')
+                else:
+                    lines = value.split('\n')
+            else: lines = ['Error']
+
+            row_values.append((lines, is_number))
+
+        for cell_h in range(lines_to_skip, row_heights[y]):
+            if lines_left <= 0: break
+            lines_left -= 1
 
-        
-        row_display = []
-        for cell_h in range(row_heights[y]):
             # row label
+            row_display = []
             row_display.append(' ')
             row_num_str = str(y)
             if cell_h == 0: row_display.append(indigo(row_num_str))
@@ -830,37 +2351,22 @@ def DISPLAY(show_equations=False):
             row_display.append(print_cadet_grey(' |'))
 
             # cells
-            for x, value in enumerate(row):
-
-                if show_equations:
-                    equation = get_equation(x, y)
-                    if equation != None: value = equation
+            for x, (lines, is_number) in enumerate(row_values, first_x):
 
                 cell_width = column_widths[x]
-                cell_name = convert_x_to_alpha_value(x) + str(y)
-                cur_line = ''
-                if value != None:
-                    lines = []
-                    if cell_name in wrapped_cell_names:
-                        lines = wrap(cell_width, value).split('\n')
-                    else:
-                        lines = value.split('\n')
-                    cur_line = '' if cell_h >= len(lines) else lines[cell_h]
-                else: cur_line = 'Error'
+                cur_line = '' if cell_h >= len(lines) else lines[cell_h]
 
                 cell_contents = []
                 cell_contents.append(' ')
-                try:
-                    float(cur_line)
+                if is_number:
                     cell_contents.append(' ' * (cell_width - len(cur_line)))
-                    cur_line = str(cur_line)
-                    if cell_name in colors: 
-                        r, g, b = colors[cell_name]
+                    if (x, y) in colors: 
+                        r, g, b = colors[(x, y)]
                         cell_contents.append(print_in_color(cur_line[:cell_width], f'\033[38;2;{r};{g};{b}m')) 
                     else: cell_contents.append(cur_line[:cell_width])
-                except ValueError:
-                    if cell_name in colors: 
-                        r, g, b = colors[cell_name]
+                else:
+                    if (x, y) in colors: 
+                        r, g, b = colors[(x, y)]
                         cell_contents.append(print_in_color(cur_line[:cell_width], f'\033[38;2;{r};{g};{b}m')) 
                     else: cell_contents.append(cur_line[:cell_width])
                     cell_contents.append(' ' * (cell_width - len(cur_line)))
@@ -883,273 +2389,644 @@ def DISPLAY(show_equations=False):
                 row_display.append(print_cadet_grey('|'))
 
             display.append(''.join(row_display))
+        lines_to_skip = 0
 
+    # the top of the frame is left off so the prompt fits below it without scrolling
+    prompt_lines = 2 if NO_COMMANDS else 3
+    draw_screen(display[max(len(display) - (terminal_height - prompt_lines), 0):], size)
 
-    # print('\n'.join(display))
 
-    # print display adjusted to fit in view 
-    size = shutil.get_terminal_size()
-    terminal_width = size.columns
-    terminal_height = size.lines
-    current_cell_terminal_x = sum([column_widths[i]+3 for i in range(0, current_x+1)]) + row_label_space+2
-    current_cell_terminal_y = sum([row_heights[i] for i in range(0, current_y+1)]) + 3
-    x_adjustment = 0
-    cols_skipped = 0
-    while current_cell_terminal_x - x_adjustment > terminal_width:
-        x_adjustment += column_widths[cols_skipped]+3
-        cols_skipped+=1
-    y_adjustment = 0
-    rows_skipped = 0
-    while current_cell_terminal_y - y_adjustment > terminal_height:
-        y_adjustment += row_heights[rows_skipped]
-        rows_skipped+=1
-    if cols_skipped > 0:
-        cols_skipped+=1
-    # if rows_skipped > 0:
-    #     rows_skipped+=1
 
-        
-
-    y_range = min(terminal_height + rows_skipped-1, len(display)+1)
-    row_ys = []
-    if rows_skipped == 0:
-        row_ys = [*range(rows_skipped, y_range)]
+def get_current_contents(x, y):
+    global cells, equations
+    if (x, y) in equations:
+        return get_equation(x, y)
+    elif y < height and x < width:
+        return tekhelet(format_cell_value(get_cell(cells, x, y)))
     else:
-        row_ys = [0, *range(rows_skipped, y_range-1)]
-
-    for y in row_ys:
-        if y >= len(display): continue
+        return ''
 
-        skipped = 0
-        i = 0
-        while skipped < cols_skipped:
-            if display[y][i] == "|":
-                skipped+=1
-            i+=1
+def read_csv_records(path: str):
+    # stream the file a row at a time, quoted cells can contain commas and newlines.
+    # yields (row number, cells) for rows and (None, line) for <meta> lines
+    csv.field_size_limit(sys.maxsize)
+    with open(path, 'r', newline='') as file:
+        y = 0
+        for record in csv.reader(file):
+            if len(record) == 0: continue
+
+            if record[0].startswith('<meta>'):
+                yield None, ','.join(record)
+            else:
+                yield y, record
+                y += 1
 
-        x_range = i
-        if cols_skipped != 0:
-            while skipped < current_x+2:
-                if display[y][x_range] == "|":
-                    skipped+=1
-                x_range+=1
+def load_meta(line: str):
+    if line.startswith('<meta> color '):
+        color_set = line.split('<meta> color ')[1]
+        target, rgb = color_set.split('=')
+        r, g, b = rgb.split(',')
+        colors[convert_cell_name_to_x_y(target)] = [int(r), int(g), int(b)]
+        recent_colors.append([r,g,b])
 
-            # row label
-            row_label = []
-            row_label.append(' ')
-            row_num_str = str(y-1) if y > 0 else str(y)
-            if y != 0: row_label.append(indigo(row_num_str))
-            else: row_label.append(' ' * (len(row_num_str)))
-            row_label.append(' ' * (row_label_space - len(row_num_str)))
-            row_label.append(print_cadet_grey(' |'))
-            print("".join(row_label), end="")
+    elif line.startswith('<meta> wrap '):
+        target = line.split('<meta> wrap ')[1]
+        wrapped_cells.add(convert_cell_name_to_x_y(target))
+
+    elif line.startswith('<meta>'):
+        equation = line.split('<meta>')[1]
+        equation = equation.replace(' ', '')
+        target, equation = equation.split('=', 1)
+        if is_cell_range(target):
+            # the equation is written for the first cell, the rest of the range share its template
+            startx, starty, endx, endy = normalize_cell_range(target)
+            template = convert_equation_to_template(equation, startx, starty)
+            for y in range(starty, endy+1):
+                for x in range(startx, endx+1):
+                    equations[(x, y)] = template
+        else:
+            x, y = convert_cell_name_to_x_y(target)
+            equations[(x, y)] = convert_equation_to_template(equation, x, y)
+
+def find_template_ranges() -> list[tuple[tuple[int, int, int, int], str]]:
+    # equations copied down a column are saved as one range, and so are
+    # the same runs copied across neighbouring columns. a range is written
+    # as the equation of its first cell, so equations with references copied
+    # off the sheet are kept out of ranges and written on their own
+    columns = {}
+    singles = []
+    for (x, y), template in equations.items():
+        if has_off_sheet_reference(template, x, y):
+            singles.append(((x, y, x, y), template))
+            continue
+        if (template, x) not in columns:
+            columns[(template, x)] = []
+        columns[(template, x)].append(y)
+
+    runs = []
+    for (template, x), rows in columns.items():
+        rows.sort()
+        start = 0
+        for i in range(1, len(rows)+1):
+            if i < len(rows) and rows[i] == rows[i-1] + 1:
+                continue
+            runs.append((template, rows[start], rows[i-1], x))
+            start = i
+
+    runs.sort()
+    ranges = []
+    for template, starty, endy, x in runs:
+        if len(ranges) > 0:
+            (startx, last_starty, endx, last_endy), last_template = ranges[-1]
+            if last_template == template and last_starty == starty and last_endy == endy and endx + 1 == x:
+                ranges[-1] = ((startx, starty, x, endy), template)
+                continue
+        ranges.append(((x, starty, x, endy), template))
+
+    ranges.extend(singles)
+    ranges.sort(key=lambda item: (item[0][1], item[0][0]))
+    return ranges
+
+def map_csv_file(path: str):
+    global mapped_file, mapped_width
+
+    with open(path, 'rb') as file:
+        mapped_file = mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # index where each row starts and ends a block at a time, rows are only parsed when they're used
+    size = len(mapped)
+    start = 0
+    while start < size:
+        end = mapped.find(b'\n', min(start + MAP_BLOCK_SIZE, size))
+        if end == -1: end = size
+        block = mapped[start:end]
+
+        # with quoted cells taken out, the newlines and commas left separate rows and cells
+        stripped = quoted_cell_pattern.sub(b'', block) if b'"' in block else block
+        while end < size and open_quote_pattern.search(stripped):
+            end = mapped.find(b'\n', end + 1)
+            if end == -1: end = size
+            block = mapped[start:end]
+            stripped = quoted_cell_pattern.sub(b'', block)
+
+        lines = block.split(b'\n')
+        lengths = list(map(len, lines))
+        line_starts = list(itertools.accumulate(map((1).__add__, lengths), initial=start))
+        stripped_lines = stripped.split(b'\n')
+
+        if len(stripped_lines) == len(lines) and not open_quote_pattern.search(stripped):
+            keep = [True] * len(lines)
+            for match in skipped_line_pattern.finditer(block):
+                i = bisect.bisect_right(line_starts, start + match.start()) - 1
+                keep[i] = False
+                if match.group().startswith(b'<meta>'):
+                    load_meta(lines[i].decode('utf-8').rstrip('\r'))
+
+            row_starts.extend(itertools.compress(line_starts, keep))
+            row_ends.extend(itertools.compress(map(operator.add, line_starts, lengths), keep))
+            columns = list(map(bytes.count, itertools.compress(stripped_lines, keep), itertools.repeat(b',')))
+            if len(columns) > 0:
+                mapped_width = max(mapped_width, max(columns) + 1)
 
-        else: 
-            x_range = len(display[y])
+        else:
+            # some cells span lines, let the csv reader say which lines make up each row
+            reader = csv.reader(line.decode('utf-8') + '\n' for line in lines)
+            last_line = 0
+            for record in reader:
+                first_line = last_line
+                last_line = reader.line_num
+                if len(record) == 0: continue
+
+                if record[0].startswith('<meta>'):
+                    load_meta(','.join(record))
+                    continue
+
+                row_starts.append(line_starts[first_line])
+                row_ends.append(line_starts[last_line] - 1)
+                mapped_width = max(mapped_width, len(record))
+
+        start = end + 1
+
+def get_cache_key(path: str) -> tuple:
+    # the cache only matches the exact csv it was made from, with this python's bytecode
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return (CACHE_VERSION, importlib.util.MAGIC_NUMBER, stat.st_size, stat.st_mtime_ns, digest.digest())
+
+def save_cache():
+    # only a sheet with every equation calculated is worth keeping
+    if not CACHE or LAZY or FILE == None or FILE == '' or rebuild_dependencies or len(dirty_cells) > 0 or len(dirty_equations) > 0:
+        return
 
-        print(display[y][i:i+x_range])
-        
+    # the sheet is nested as bytes, so the key can be checked without loading all of it
+    sheet = marshal.dumps((
+        cells, width, height, equations, colors, wrapped_cells,
+        compiled_equations, equation_references, equation_ranges, equation_dependents, equation_branch_reads
+    ))
+    path = FILE + '.msc'
+    with open(path + '.tmp', 'wb') as file:
+        file.write(marshal.dumps((get_cache_key(FILE), sheet)))
+    os.replace(path + '.tmp', path)
+
+def load_cache() -> bool:
+    global cells, width, height, equations, colors, wrapped_cells, rebuild_dependencies
+
+    path = FILE + '.msc'
+    if not CACHE or not os.path.exists(path):
+        return False
 
+    try:
+        with open(path, 'rb') as file:
+            key, sheet = marshal.loads(file.read())
+        if key != get_cache_key(FILE):
+            return False
+        (
+            cells, width, height, equations, colors, wrapped_cells,
+            cached_equations, cached_references, cached_ranges, cached_dependents, cached_branch_reads
+        ) = marshal.loads(sheet)
+    except (EOFError, ValueError, TypeError):
+        return False
 
-def get_current_contents(cell_name, x, y):
-    global cells, equations
-    if cell_name in equations:
-        return '=' + equations[cell_name]
-    elif y < len(cells) and x < len(cells[y]):
-        return tekhelet(cells[y][x])
-    else:
-        return ''
+    compiled_equations.clear()
+    compiled_equations.update(cached_equations)
+    equation_references.clear()
+    equation_references.update(cached_references)
+    equation_ranges.clear()
+    equation_ranges.update(cached_ranges)
+    range_columns.clear()
+    for target, ranges in equation_ranges.items():
+        add_range_columns(target, ranges)
+    equation_dependents.clear()
+    equation_dependents.update(cached_dependents)
+    equation_branch_reads.clear()
+    equation_branch_reads.update(cached_branch_reads)
+    column_prefix_sums.clear()
+    column_indexes.clear()
+    range_statistics.clear()
+    statistics_columns.clear()
+    dirty_cells.clear()
+    dirty_equations.clear()
+    rebuild_dependencies = False
+
+    for r, g, b in colors.values():
+        recent_colors.append([str(r), str(g), str(b)])
+    return True
 
 def LOAD():
-    global cells, equations, width, height, FILE, wrapped_cell_names, actions, undone_actions, command_stack, colors
+    global cells, equations, width, height, FILE, wrapped_cells, actions, undone_actions, command_stack, colors, rebuild_dependencies, loading_records, mapped_file, mapped_width, unsaved_changes, saved_as, current_action, undo_size, journal_file, rebuild_layout, rebuild_bounds
 
-    cells=[['']]
+    cells = {}
     width=1
     height=1
     equations = {}
-    wrapped_cell_names = set()
+    equation_branch_reads.clear()
+    rebuild_dependencies = True
+    wrapped_cells = set()
+
+    # the layout counters still measure the last file
+    rebuild_layout = True
+    rebuild_bounds = True
 
     actions = []
     undone_actions = []
+    current_action = None
+    undo_size = 0
 
     command_stack = []
 
+    # the journal of the last file is left for when it's opened again
+    close_journal()
+
+    # drop the last mapped file
+    if mapped_file != None:
+        mapped_file.close()
+        mapped_file = None
+    del row_starts[:]
+    del row_ends[:]
+    row_cache.clear()
+    mapped_width = 0
+
+    loading_records = None
+    if (FILE != None and FILE != '' and LAZY and os.path.getsize(FILE) > 0):
+        map_csv_file(FILE)
+        width = max(width, mapped_width)
+        height = max(height, len(row_starts))
+
+    elif (FILE != None and FILE != '' and not load_cache()):
+        loading_records = read_csv_records(FILE)
+
+        # show the first screen before reading the rest of the file
+        LOAD_RECORDS(shutil.get_terminal_size().lines)
+        if loading_records != None:
+            DISPLAY()
+            LOAD_RECORDS()
 
-    csv_str = ''
-    if (FILE != None and FILE != ''):
-        # READ if provided file
-        with open(FILE, 'r') as file:
-            csv_str = file.read()
+        # calculate now, so the cache is ready for next time
+        if CACHE:
+            APPLY_EQUATIONS()
+            save_cache()
 
-        # PARSE CSV
-        cells.clear()
+    # the first screen was laid out from part of the file
+    rebuild_layout = True
+    rebuild_bounds = True
+    unsaved_changes = False
+    saved_as = (FILE, width, height)
+
+    # recover edits from a session that ended without saving
+    if FILE != None and FILE != '' and replay_journal():
+        unsaved_changes = True
+
+def LOAD_RECORDS(limit: int = None):
+    global width, height, loading_records
 
-        lines = csv_str.split('\n')
-        for i, line in enumerate(lines):
-            if not line.startswith('<meta>') and line != '':
-                line_cells = []
-                in_quotes = False
-                last = 0
-                for c in range(0, len(line)):
-                    if line[c] == '"' and not in_quotes:
-                        in_quotes = True
-                    elif in_quotes and line[c] == '"' and c+1 < len(line) and line[c+1] != '"' and c-1 > 0 and line[c-1] != '"':
-                        in_quotes = False
-                    elif (line[c] == ',') and not in_quotes:
-                        cell = line[last:c]
-                        if cell.startswith("\"") and cell.endswith("\""):
-                            cell = cell.replace("\"\"", "\"")
-                            cell = cell[1:-1]
-                            
-                        line_cells.append(cell)
-                        last = c+1
-
-                    
-                cell = line[last:]
-                if cell.startswith("\"") and cell.endswith("\""):
-                    cell = cell.replace("\"\"", "\"")
-                    cell = cell[1:-1]
-                line_cells.append(cell)
-
-                cells.append(line_cells)
+    rows_read = 0
+    for y, record in loading_records:
 
         # PARSE META DATA
-        for i, line in enumerate(lines):
-            if line.startswith('<meta> color '):
-                color_set = line.split('<meta> color ')[1]
-                target, rgb = color_set.split('=')
-                r, g, b = rgb.split(',')
-                colors[target] = [int(r), int(g), int(b)]
-                recent_colors.append([r,g,b])
+        if y == None:
+            load_meta(record)
+            continue
 
-            elif line.startswith('<meta> wrap '):
-                target = line.split('<meta> wrap ')[1]
-                wrapped_cell_names.add(target)
+        # PARSE CSV
+        row = {x: parse_cell_value(cell) for x, cell in enumerate(record) if cell != ''}
+        if len(row) > 0:
+            cells[y] = row
+        width = max(width, len(record))
+        height = max(height, y+1)
 
-            elif line.startswith('<meta>'):
-                equation = line.split('<meta>')[1]
-                equation = equation.replace(' ', '')
-                target, equation = equation.split('=')
-                equations[target] = equation
+        rows_read += 1
+        if limit != None and rows_read >= limit:
+            return
 
+    loading_records = None
 
-    if len(cells) == 0:
-        cells.append([''])
+def format_csv_value(value) -> str:
+    value = format_cell_value(value)
+    if value == None:
+        return ''
 
-    width = len(cells[0])
-    for row in cells:
-        if len(row) > width: width = len(row)
-    height = len(cells)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        value = value.replace("\"", "\"\"")
+        value = f'"{value}"'
+    return value
 
 def SAVE():
-    global cells, FILE, equations, wrapped_cell_names
+    global cells, FILE, equations, wrapped_cells, unsaved_changes, saved_as
 
     if FILE == None or FILE == '': 
         print(mint_green('file path: '), end='')
         FILE = input()
+    elif not unsaved_changes and saved_as == (FILE, width, height):
+        print(mint_green('no changes to save to ') + FILE)
+        return
     else:
         print(mint_green('saving to ') + FILE)
 
-    with open(FILE, 'w') as file:
-        for y, row in enumerate(cells):
-            for x, value in enumerate(row):
-
-                formated_val = value
-                if ',' in formated_val:
-                    if "\"" in formated_val:
-                        formated_val = formated_val.replace("\"", "\"\"")
-                    formated_val = f'"{formated_val}"'
-
-                file.write(str(formated_val))
-                if x != len(row)-1:
-                    file.write(',')
-            file.write('\n')
-
-        for target_cell_name, equation in equations.items():
-            file.write('<meta> ')
-            file.write(target_cell_name)
-            file.write('=')
-            file.write(equation)
-            file.write('\n')
-
-        for target_cell_name, [r, g, b] in colors.items():
-            file.write('<meta> color ')
-            file.write(target_cell_name)
-            file.write('=')
-            file.write(str(r) + ',' + str(g) + ',' + str(b))
-            file.write('\n')
-
-        for target_cell_name in wrapped_cell_names:
-            file.write('<meta> wrap ')
-            file.write(target_cell_name)
-            file.write('\n')
-
-    
-    file.close()
+    # write next to FILE and swap it in, so a crash part way through doesn't lose the old file
+    path = FILE + '.tmp'
+    with open(path, 'w') as file:
+        buffer = []
+        buffered = 0
+        empty_row = ',' * (width-1)
+        for y in range(height):
+            if y not in cells and y < len(row_starts):
+                # rows of a mapped file that weren't edited are copied over as they are
+                line = mapped_file[row_starts[y]:row_ends[y]].decode('utf-8')
+            elif y not in cells:
+                line = empty_row
+            else:
+                values = [''] * width
+                for x, value in cells[y].items():
+                    values[x] = format_csv_value(value)
+                line = ','.join(values)
+
+            buffer.append(line)
+            buffer.append('\n')
+            buffered += len(line)
+            if buffered >= SAVE_BUFFER_SIZE:
+                file.write(''.join(buffer))
+                buffer = []
+                buffered = 0
+
+        for (startx, starty, endx, endy), template in find_template_ranges():
+            target = convert_x_y_to_cell_name(startx, starty)
+            if endx != startx or endy != starty:
+                target += ':' + convert_x_y_to_cell_name(endx, endy)
+            buffer.append('<meta> ' + target + '=' + convert_template_to_equation(template, startx, starty) + '\n')
+
+        for (x, y), [r, g, b] in colors.items():
+            buffer.append('<meta> color ' + convert_x_y_to_cell_name(x, y) + '=' + str(r) + ',' + str(g) + ',' + str(b) + '\n')
+
+        for x, y in wrapped_cells:
+            buffer.append('<meta> wrap ' + convert_x_y_to_cell_name(x, y) + '\n')
+
+        file.write(''.join(buffer))
+        file.flush()
+        os.fsync(file.fileno())
+
+    if os.path.exists(FILE):
+        shutil.copymode(FILE, path)
+    os.replace(path, FILE)
+
+    unsaved_changes = False
+    saved_as = (FILE, width, height)
+    remove_journal()
+    save_cache()
+
+def record_undo(kind: str, target: tuple[int, int], value):
+    # an action keeps what each target was before it first changed
+    global undo_size
+    journal_pending.add((kind, target))
+    if kind != 'colors':
+        note_layout_change(target)
+    if current_action == None or target in current_action[kind]:
+        return
 
-def WRITE_ACTION_FOR_UNDO():
-    global cells, width, height, equations, wrapped_cell_names, colors
-    actions.append({
-        'cells': copy.deepcopy(cells),
+    current_action[kind][target] = value
+    current_action['size'] += 1
+    undo_size += 1
+
+    # drop the oldest actions once too many changes are kept
+    while undo_size > MAX_UNDO_CHANGES and len(actions) > 1:
+        undo_size -= actions.pop(0)['size']
+
+def start_action() -> dict:
+    global current_action
+    current_action = {
+        'cells': {},
+        'equations': {},
+        'wrapped_cells': {},
+        'colors': {},
         'width': width,
         'height': height,
-        'equations': copy.deepcopy(equations),
-        'wrapped_cell_names': copy.deepcopy(wrapped_cell_names),
-        'colors': copy.deepcopy(colors)
-    })
+        'size': 0,
+        'before': None,     # action that happened before the rows or columns were shifted
+        'shift': None       # (is_row, start, offset) passed to shift_sheet
+    }
+    return current_action
+
+def record_shift(is_row: bool, start: int, offset: int):
+    # what the action changed so far is in the old positions, so it's kept whole and undone after the shift
+    global current_action
+    append_journal({'shift': [is_row, start, offset], 'width': width, 'height': height})
+    if current_action == None:
+        return
+
+    before = current_action
+    action = start_action()
+    action['before'] = before
+    action['shift'] = (is_row, start, offset)
+    action['size'] = before['size']
+    if len(actions) > 0 and actions[-1] is before:
+        actions[-1] = action
+
+def restore_action(action: dict) -> dict:
+    # put back what an action recorded, recording what that replaces so it can be put back too
+    global width, height, current_action
+
+    reverse_action = start_action()
+    for (x, y), value in action['cells'].items():
+        set_cell(cells, x, y, value)
+
+    # emptying a cell wipes its color, but a color the action didn't touch was there before it too
+    for target, rgb in list(reverse_action['colors'].items()):
+        if target not in action['colors']:
+            colors[target] = rgb
+
+    for (x, y), equation in action['equations'].items():
+        if equation == None:
+            remove_equation(x, y)
+        else:
+            set_equation(x, y, equation)
+
+    for target, wrapped in action['wrapped_cells'].items():
+        record_undo('wrapped_cells', target, target in wrapped_cells)
+        if wrapped:
+            wrapped_cells.add(target)
+        else:
+            wrapped_cells.discard(target)
+
+    for target, rgb in action['colors'].items():
+        record_undo('colors', target, colors.get(target))
+        if rgb == None:
+            colors.pop(target, None)
+        else:
+            colors[target] = rgb
+
+    width = action['width']
+    height = action['height']
+    current_action = None
+
+    # shift back, then undo what came before the shift
+    if action['shift'] != None:
+        is_row, start, offset = action['shift']
+        move_lines(is_row, start + offset, -offset)
+        reverse_after = reverse_action
+        reverse_action = restore_action(action['before'])
+        reverse_action['before'] = reverse_after
+        reverse_action['shift'] = (is_row, start + offset, -offset)
+        reverse_action['size'] += reverse_after['size']
+
+    return reverse_action
+
+def write_journal():
+    if len(journal_pending) == 0:
+        return
+    if FILE == None or FILE == '':
+        journal_pending.clear()
+        return
 
+    entry = {'cells': [], 'equations': [], 'wrapped_cells': [], 'colors': [], 'width': width, 'height': height}
+    for kind, (x, y) in journal_pending:
+        if kind == 'cells':
+            # equation results are calculated again when the journal is replayed
+            if (x, y) in equations: continue
+            row = get_row(y)
+            entry['cells'].append([x, y, '' if row == None else row.get(x, '')])
+        elif kind == 'equations':
+            entry['equations'].append([x, y, equations.get((x, y))])
+        elif kind == 'wrapped_cells':
+            entry['wrapped_cells'].append([x, y, (x, y) in wrapped_cells])
+        elif kind == 'colors':
+            entry['colors'].append([x, y, colors.get((x, y))])
+    journal_pending.clear()
+    if not any(len(entry[kind]) > 0 for kind in ('cells', 'equations', 'wrapped_cells', 'colors')):
+        return
+
+    append_journal(entry)
+
+def append_journal(entry: dict):
+    global journal_file, journal_unsynced
+    if FILE == None or FILE == '':
+        return
+
+    # the journal starts with the size and time of the csv it applies to
+    if journal_file == None:
+        journal_file = open(FILE + '.journal', 'a')
+        if journal_file.tell() == 0:
+            stat = os.stat(FILE)
+            journal_file.write(json.dumps({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}) + '\n')
+
+    journal_file.write(json.dumps(entry) + '\n')
+    journal_file.flush()
+    journal_unsynced = True
+
+    # sync in batches. whatever is left is synced by read_char when typing stops,
+    # so an os crash loses at most about the last JOURNAL_SYNC_SECONDS of edits
+    if time.monotonic() - journal_synced >= JOURNAL_SYNC_SECONDS:
+        sync_journal()
+
+def sync_journal():
+    global journal_synced, journal_unsynced
+    if journal_file != None and journal_unsynced:
+        os.fsync(journal_file.fileno())
+    journal_synced = time.monotonic()
+    journal_unsynced = False
+
+def close_journal():
+    global journal_file
+    if journal_file != None:
+        os.fsync(journal_file.fileno())
+        journal_file.close()
+        journal_file = None
+
+def remove_journal():
+    global journal_file, journal_unsynced
+    journal_unsynced = False
+    if journal_file != None:
+        journal_file.close()
+        os.remove(journal_file.name)
+        journal_file = None
+    if FILE != None and FILE != '' and os.path.exists(FILE + '.journal'):
+        os.remove(FILE + '.journal')
+    journal_pending.clear()
+
+def replay_journal() -> bool:
+    global width, height
+
+    path = FILE + '.journal'
+    if not os.path.exists(path):
+        return False
+
+    with open(path, 'r') as file:
+        lines = file.read().split('\n')
+
+    # edits made to an older version of the csv can't be replayed on this one
+    stat = os.stat(FILE)
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        header = None
+    if header != {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}:
+        os.remove(path)
+        return False
+
+    for line in lines[1:]:
+        # the last line is cut short if the crash came while writing it
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            break
+
+        if 'shift' in entry:
+            shift_sheet(*entry['shift'])
+            width = entry['width']
+            height = entry['height']
+            continue
+
+        for x, y, value in entry['cells']:
+            set_cell(cells, x, y, value)
+        for x, y, equation in entry['equations']:
+            if equation == None:
+                remove_equation(x, y)
+            else:
+                set_equation(x, y, equation)
+        for x, y, wrapped in entry['wrapped_cells']:
+            if wrapped:
+                wrapped_cells.add((x, y))
+            else:
+                wrapped_cells.discard((x, y))
+        for x, y, rgb in entry['colors']:
+            if rgb == None:
+                colors.pop((x, y), None)
+            else:
+                colors[(x, y)] = rgb
+        width = entry['width']
+        height = entry['height']
+
+    journal_pending.clear()
+    return True
+
+def WRITE_ACTION_FOR_UNDO():
+    global unsaved_changes, undo_size
+    unsaved_changes = True
+
+    for action in undone_actions:
+        undo_size -= action['size']
     undone_actions.clear()
 
-def UNDO():
-    global cells, width, height, equations, wrapped_cell_names, colors
+    actions.append(start_action())
 
+def UNDO():
+    global unsaved_changes, undo_size
     if len(actions) == 0: return
 
-    # pop last state
-    last_state = actions.pop()
-
-    # add current state to undone actions
-    undone_actions.append({
-        'cells': copy.deepcopy(cells),
-        'width': width,
-        'height': height,
-        'equations': copy.deepcopy(equations),
-        'wrapped_cell_names': copy.deepcopy(wrapped_cell_names),
-        'colors': copy.deepcopy(colors)
-    })
-
-    # reset to last state
-    cells = copy.deepcopy(last_state['cells'])
-    width = last_state['width']
-    height = last_state['height']
-    equations = copy.deepcopy(last_state['equations'])
-    wrapped_cell_names = copy.deepcopy(last_state['wrapped_cell_names'])
-    colors = copy.deepcopy(last_state['colors'])
+    action = actions.pop()
+    undo_size -= action['size']
+    undone_actions.append(restore_action(action))
+    unsaved_changes = True
 
 def REDO():
-    global cells, width, height, equations, wrapped_cell_names, colors
+    global unsaved_changes, undo_size
     if len(undone_actions) == 0: return
 
-    # pop undone state
-    previous_state = undone_actions.pop()
-
-    # add current state to actions
-    actions.append({
-        'cells': copy.deepcopy(cells),
-        'width': width,
-        'height': height,
-        'equations': copy.deepcopy(equations),
-        'wrapped_cell_names': copy.deepcopy(wrapped_cell_names),
-        'colors': copy.deepcopy(colors)
-    })
-
-    # reset to undone state
-    cells = copy.deepcopy(previous_state['cells'])
-    width = previous_state['width']
-    height = previous_state['height']
-    equations = copy.deepcopy(previous_state['equations'])
-    wrapped_cell_names = copy.deepcopy(previous_state['wrapped_cell_names'])
-    colors = copy.deepcopy(previous_state['colors'])
+    action = undone_actions.pop()
+    undo_size -= action['size']
+    actions.append(restore_action(action))
+    unsaved_changes = True
 
 def COPY(cell_names: list[str], cut: bool):
     global cells, equations, operators, current_cell,m, colors
@@ -1184,14 +3061,12 @@ def COPY(cell_names: list[str], cut: bool):
     source_values = []
     for x, y in source_cells:
         # get value
-        value = ''
-        if y < len(cells) and x < len(cells[y]):
-            value = cells[y][x]
-        source_cell_name = convert_x_to_alpha_value(x) + str(y)
+        value = get_cell(cells, x, y)
+        if value == None: value = ''
         
         r = g = b = None
-        if source_cell_name in colors:
-            r, g, b = colors[source_cell_name]
+        if (x, y) in colors:
+            r, g, b = colors[(x, y)]
 
         source_values.append([x, y, value, [r, g, b]])
 
@@ -1200,8 +3075,8 @@ def COPY(cell_names: list[str], cut: bool):
             set_cell(cells, x, y, '')
 
 
-    # set target values
-    new_equations = copy.deepcopy(equations)
+    # set target values, equations are written after all of them are read
+    new_equations = {}  # target -> equation, or None to remove it
     inserts = set()
     for x, y, value, [r, g, b] in source_values:
 
@@ -1211,28 +3086,33 @@ def COPY(cell_names: list[str], cut: bool):
         target_x = target_start_x + offset_from_start_x
         target_y = target_start_y + offset_from_start_y
 
-        # modify if equation
-        source_cell_name = convert_x_to_alpha_value(x) + str(y)
-        target_name = convert_x_to_alpha_value(target_x) + str(target_y)
-        if source_cell_name in equations:
-            value = modify_equation(source_cell_name, x, y, target_x, target_y)
-            if source_cell_name not in inserts and cut:
-                del new_equations[source_cell_name]
-            new_equations[target_name] = value
-            inserts.add(target_name)
+        # templates are relative, so the copy shares the same one
+        target = (target_x, target_y)
+        if (x, y) in equations:
+            value = equations[(x, y)]
+            if (x, y) not in inserts and cut:
+                new_equations[(x, y)] = None
+            new_equations[target] = value
+            inserts.add(target)
         else:
             set_cell(cells, target_x, target_y, value)
 
         # copy colors
         if r != None:
-            colors[target_name] = [r, g, b]
-        elif target_name in colors:
-            del colors[target_name]
+            record_undo('colors', target, colors.get(target))
+            colors[target] = [r, g, b]
+        elif target in colors:
+            record_undo('colors', target, colors[target])
+            del colors[target]
 
         last_x = target_x
         last_y = target_y
 
-    equations = new_equations
+    for (x, y), equation in new_equations.items():
+        if equation == None:
+            remove_equation(x, y)
+        else:
+            set_equation(x, y, equation)
 
 
     set_current_cell(last_x, last_y)
@@ -1253,14 +3133,14 @@ def WRAP(command):
         target_cells.append([x, y])
 
     for x, y in target_cells:
-        cell_name = convert_x_to_alpha_value(x) + str(y)
-        if cell_name in wrapped_cell_names:
-            wrapped_cell_names.remove(cell_name)
+        record_undo('wrapped_cells', (x, y), (x, y) in wrapped_cells)
+        if (x, y) in wrapped_cells:
+            wrapped_cells.remove((x, y))
         else: 
-            wrapped_cell_names.add(cell_name)
+            wrapped_cells.add((x, y))
 
 def CLEAR(cell_names: list[str]):
-    global cells, equations, wrapped_cell_names, colors
+    global cells, equations, wrapped_cells, colors
 
     WRITE_ACTION_FOR_UNDO()
 
@@ -1271,14 +3151,13 @@ def CLEAR(cell_names: list[str]):
 
     for x in range(startx, endx + 1):
         for y in range(starty, endy + 1):
-            cell_name = convert_x_to_alpha_value(x) + str(y)
             set_cell(cells, x, y, '')
-            if cell_name in equations:
-                del equations[cell_name]
-            if cell_name in wrapped_cell_names:
-                wrapped_cell_names.remove(cell_name)
-            if cell_name in colors:
-                del colors[cell_name]
+            remove_equation(x, y)
+            if (x, y) in wrapped_cells:
+                record_undo('wrapped_cells', (x, y), True)
+                wrapped_cells.discard((x, y))
+            if (x, y) in colors:
+                record_undo('colors', (x, y), colors.pop((x, y)))
 
 def MOVE():
     global current_cell
@@ -1295,100 +3174,218 @@ def MOVE():
 
     ch = ''
     escaped = False
-    while ch != '\n' and ch != '\r':
-        
-        tty.setraw(sys.stdin.fileno())
-        ch = sys.stdin.read(1)
-        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        if ch == '\n' or ch == '\r':
-            break
+    try:
+        tty.setraw(fd)
+        while ch != '\n' and ch != '\r':
+            ch = read_char()
+            if ch == '\n' or ch == '\r' or ch == '':
+                break
 
-        x, y = convert_cell_name_to_x_y(current_cell)
+            x, y = convert_cell_name_to_x_y(current_cell)
 
-        # handle arrow key movement
-        if not escaped:
-            if ch == '\x1b':
-                escaped = True
-            elif ch == 'j':
-                if x > 0:
-                    x -= 1
-            elif ch == 'l':
-                x += 1
-            elif ch == 'i':
-                if y > 0:
-                    y -= 1
-            elif ch == 'k':
-                y += 1
-        elif escaped:
-            ch = sys.stdin.read(1)
-            
-            if ch == 'D':
-                if x > 0:
-                    x -= 1
-            elif ch == 'C':
-                x += 1
-            elif ch == 'A':
-                if y > 0:
-                    y -= 1
-            elif ch == 'B':
-                y += 1
+            # handle arrow key movement
+            if not escaped:
+                if ch == '\x1b':
+                    escaped = True
+                elif ch == 'j':
+                    if x > 0:
+                        x -= 1
+                elif ch == 'l':
+                    x += 1
+                elif ch == 'i':
+                    if y > 0:
+                        y -= 1
+                elif ch == 'k':
+                    y += 1
+            elif escaped:
+                ch = read_char()
 
-            escaped = False
+                if ch == 'D':
+                    if x > 0:
+                        x -= 1
+                elif ch == 'C':
+                    x += 1
+                elif ch == 'A':
+                    if y > 0:
+                        y -= 1
+                elif ch == 'B':
+                    y += 1
 
+                escaped = False
 
-        set_current_cell(x, y-1)
-        
-        print(f"\033[{4}G", end='') # go to start of line
-        print("\033[K", end='') # clear to end of line
-
-        # reprint everything
-        TRIM_CELLS()
-        APPLY_EQUATIONS()
-        DISPLAY()
-   
-def INSERT_ROW():
-    global current_cell, width, height
-    x, y = convert_cell_name_to_x_y(current_cell)
 
-    last_alpha = convert_x_to_alpha_value(width)
+            set_current_cell(x, y-1)
 
-    cut_command = ['a' + str(y) + ':' + last_alpha + str(height), 'a' + str(y+1)]
+            # keys held down are all moved through before drawing
+            if escaped or key_pending():
+                continue
 
-    CUT(cut_command)
+            print(f"\033[{4}G", end='') # go to start of line
+            print("\033[K", end='') # clear to end of line
 
-def INSERT_COL():
-    global current_cell, width, height
-    x, y = convert_cell_name_to_x_y(current_cell)
-    curr_alpha = convert_x_to_alpha_value(x)
-    next_alpha = convert_x_to_alpha_value(x+1)
+            # moving doesn't change any values, so nothing is recalculated
+            TRIM_CELLS()
+            DISPLAY()
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
 
-    last_alpha = convert_x_to_alpha_value(width)
+def shift_keys(values: dict, start: int, offset: int) -> dict:
+    return {(i + offset if i >= start else i): value for i, value in values.items()}
+
+def shift_target(target: tuple[int, int], is_row: bool, start: int, offset: int) -> tuple[int, int]:
+    x, y = target
+    if is_row and y >= start:
+        return x, y + offset
+    if not is_row and x >= start:
+        return x + offset, y
+    return target
+
+def shift_sheet(is_row: bool, start: int, offset: int):
+    # rows (or columns) from start on move by offset, one either way. when moving
+    # back the row or column before start is dropped, so it has to be empty
+    global width, height, mapped_width, rebuild_dependencies, unsaved_changes, column_tree, row_tree
+
+    # pending layout changes were measured where the cells are now
+    if not rebuild_layout:
+        update_layout(layout_equations)
+
+    if is_row:
+        if offset < 0:
+            cells.pop(start - 1, None)
+        shifted = shift_keys(cells, start, offset)
+        cells.clear()
+        cells.update(shifted)
+
+        # a row of a mapped file is inserted as an emptied row, so the file isn't shown through
+        if offset > 0 and start < len(row_starts):
+            row_starts.insert(start, 0)
+            row_ends.insert(start, 0)
+            cells[start] = {}
+        elif offset < 0 and start - 1 < len(row_starts):
+            del row_starts[start - 1]
+            del row_ends[start - 1]
+        row_cache.clear()
+        height = max(height + offset, 1)
+    else:
+        # mapped rows can't have their columns moved, so they're all read in
+        read_mapped_rows()
+        for y, row in cells.items():
+            if offset < 0:
+                row.pop(start - 1, None)
+            cells[y] = shift_keys(row, start, offset)
+        if (start if offset > 0 else start - 1) < mapped_width:
+            mapped_width += offset
+        width = max(width + offset, 1)
+
+    for targets in (equations, colors):
+        shifted = {shift_target(target, is_row, start, offset): value for target, value in targets.items()}
+        targets.clear()
+        targets.update(shifted)
+    shifted = {shift_target(target, is_row, start, offset) for target in wrapped_cells}
+    wrapped_cells.clear()
+    wrapped_cells.update(shifted)
+
+    # the used area and layout only move along the shifted axis
+    counts, heap = (row_counts, used_rows) if is_row else (column_counts, used_columns)
+    shifted = shift_keys(counts, start, offset)
+    counts.clear()
+    counts.update(shifted)
+    heap[:] = [-i for i in counts]
+    heapq.heapify(heap)
+
+    if not rebuild_layout:
+        measures = row_cell_lines if is_row else column_cell_widths
+        # the dropped line is empty, but can still have an emptied counter
+        if offset < 0:
+            measures.pop(start - 1, None)
+        shifted = shift_keys(measures, start, offset)
+        measures.clear()
+        measures.update(shifted)
+        if is_row:
+            del row_heights[:]
+            row_tree = []
+        else:
+            del column_widths[:]
+            column_tree = []
+
+    # every equation moved, so the graph is built again
+    column_prefix_sums.clear()
+    column_indexes.clear()
+    range_statistics.clear()
+    statistics_columns.clear()
+    dirty_cells.clear()
+    dirty_equations.clear()
+    equation_branch_reads.clear()
+    rebuild_dependencies = True
+    unsaved_changes = True
+
+def move_lines(is_row: bool, start: int, offset: int):
+    # changes so far are journaled in their old positions
+    write_journal()
+    shift_sheet(is_row, start, offset)
+    record_shift(is_row, start, offset)
+
+def shift_references(is_row: bool, start: int, offset: int):
+    # references to rows (or columns) that moved follow them. templates are relative,
+    # so they change when an equation and what it references didn't move together
+    for (x, y), template in list(equations.items()):
+        old_x, old_y = shift_target((x, y), is_row, start + offset, -offset)
+        def shift_reference(match):
+            reference = (old_x + int(match.group(2)), old_y + int(match.group(1)))
+            other_x, other_y = shift_target(reference, is_row, start, offset)
+            return f'R[{other_y - y}]C[{other_x - x}]'
+        shifted = sys.intern(template_reference_pattern.sub(shift_reference, template))
+        if shifted != template:
+            set_equation(x, y, shifted)
+
+def clear_line(is_row: bool, i: int):
+    # empties a row or column before it's deleted, so undo can put it back
+    if is_row:
+        row = get_row(i) or {}
+        targets = [(x, i) for x in row]
+    else:
+        read_mapped_rows()
+        targets = [(i, y) for y, row in cells.items() if i in row]
+
+    for x, y in targets:
+        set_cell(cells, x, y, '')
+    for target in [target for target in equations if target[is_row] == i]:
+        remove_equation(*target)
+    for target in [target for target in wrapped_cells if target[is_row] == i]:
+        record_undo('wrapped_cells', target, True)
+        wrapped_cells.discard(target)
+    for target in [target for target in colors if target[is_row] == i]:
+        record_undo('colors', target, colors.pop(target))
 
-    cut_command = [curr_alpha + '0' + ':' + last_alpha + str(height), next_alpha + '0']
+def INSERT_ROW():
+    x, y = convert_cell_name_to_x_y(current_cell)
 
-    CUT(cut_command)
+    WRITE_ACTION_FOR_UNDO()
+    move_lines(True, y, 1)
+    shift_references(True, y, 1)
 
-def DELETE_ROW():
-    global current_cell, width, height
+def INSERT_COL():
     x, y = convert_cell_name_to_x_y(current_cell)
 
-    last_alpha = convert_x_to_alpha_value(width)
+    WRITE_ACTION_FOR_UNDO()
+    move_lines(False, x, 1)
+    shift_references(False, x, 1)
 
-    cut_command = ['a' + str(y+1) + ':' + last_alpha + str(height), 'a' + str(y)]
+def DELETE_ROW():
+    x, y = convert_cell_name_to_x_y(current_cell)
 
-    CUT(cut_command)
+    WRITE_ACTION_FOR_UNDO()
+    clear_line(True, y)
+    move_lines(True, y+1, -1)
+    shift_references(True, y+1, -1)
 
 def DELETE_COL():
-    global current_cell, width, height
     x, y = convert_cell_name_to_x_y(current_cell)
-    curr_alpha = convert_x_to_alpha_value(x)
-    next_alpha = convert_x_to_alpha_value(x+1)
-
-    last_alpha = convert_x_to_alpha_value(width)
-
-    cut_command = [next_alpha + '0' + ':' + last_alpha + str(height), curr_alpha + '0']
 
-    CUT(cut_command)
+    WRITE_ACTION_FOR_UNDO()
+    clear_line(False, x)
+    move_lines(False, x+1, -1)
+    shift_references(False, x+1, -1)
 
 recent_colors = []
 def PICK_COLOR():
@@ -1406,6 +3403,7 @@ def PICK_COLOR():
     old_settings = termios.tcgetattr(fd)
 
     print("\033[?25l", end='') # hide cursor
+    screen_lines.clear()
 
     digits=[]
     ch = ''
@@ -1440,7 +3438,7 @@ def PICK_COLOR():
 
         
         tty.setraw(sys.stdin.fileno())
-        ch = sys.stdin.read(1)
+        ch = read_char()
         termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
         if ch == '\n' or ch == '\r':
             break
@@ -1465,7 +3463,7 @@ def PICK_COLOR():
                 digits.append(ch)
                 
         elif escaped:
-            ch = sys.stdin.read(1)
+            ch = read_char()
             
             if ch == 'D':
                 modification -= 1
@@ -1525,6 +3523,7 @@ DISPLAY()
 
 
 show_instructions = not NO_COMMANDS
+drawing_deferred = False
 
 # loop
 while True:
@@ -1599,10 +3598,13 @@ while True:
                 ice_blue('q') + tekhelet(' - quit')
             )
             show_instructions = False
-        if not NO_COMMANDS: print(mint_green('arrow keys to move, \'h\' to see commands'))
-        print(mint_green('$: '), end='')
+            screen_lines.clear()
+        if not drawing_deferred:
+            if not NO_COMMANDS: print(mint_green('arrow keys to move, \'h\' to see commands'))
+            print(mint_green('$: '), end='')
         command, return_type = input_f()
         command_stack.append(command)
+        drawing_deferred = False
 
         # selecting stuff
         if return_type == "<SHIFT>" and not is_selecting:
@@ -1620,6 +3622,7 @@ while True:
 
         
         reprint = False
+        moved = False
         if command == 'd':
             reprint = True
         elif command == 'i' or command.startswith("i "):
@@ -1630,7 +3633,7 @@ while True:
             else:
                 cell_name = command[2:]
                 x, y = convert_cell_name_to_x_y(cell_name)
-                contents = get_current_contents(cell_name, x, y)
+                contents = get_current_contents(x, y)
                 print()
                 print(ice_blue('--- CONTENTS ' + cell_name + ' ---'))
                 print(
@@ -1685,7 +3688,10 @@ while True:
         elif command == 'color':
             reprint = True
             r,g,b = PICK_COLOR()
-            colors[current_cell] = [r,g,b]
+            target = convert_cell_name_to_x_y(current_cell)
+            record_undo('colors', target, colors.get(target))
+            colors[target] = [r,g,b]
+            unsaved_changes = True
         elif command.startswith("w "):
             WRAP(command)
             reprint = True
@@ -1719,6 +3725,7 @@ while True:
         elif command == 'h':
             show_instructions = True
         elif command == 'l':
+            screen_lines.clear()
             print(mint_green('file path: '), end='')
             FILE = input()
             LOAD()
@@ -1741,14 +3748,14 @@ while True:
                 set_current_cell(x-1, y, '')
             if is_selecting:
                 selected_cells[1] = current_cell
-            reprint = True
+            moved = True
         elif command == "<RIGHT>":
             command_stack.pop()
             x, y = convert_cell_name_to_x_y(current_cell)
             set_current_cell(x+1, y, '')
             if is_selecting:
                 selected_cells[1] = current_cell
-            reprint = True
+            moved = True
         elif command == "<UP>":
             command_stack.pop()
             x, y = convert_cell_name_to_x_y(current_cell)
@@ -1756,22 +3763,24 @@ while True:
                 set_current_cell(x, y-1, '')
             if is_selecting:
                 selected_cells[1] = current_cell
-            reprint = True
+            moved = True
         elif command == "<DOWN>":
             command_stack.pop()
             x, y = convert_cell_name_to_x_y(current_cell)
             set_current_cell(x, y+1, '')
             if is_selecting:
                 selected_cells[1] = current_cell
-            reprint = True
+            moved = True
         else:
             reprint = True
 
             # add to stack
             WRITE_ACTION_FOR_UNDO()
 
-            if '=' in command and not command.startswith('='):
-                cell_name, value = command.split('=', 1)
+            # a1=5 sets a1, but =a1>=5 and if(a1=5,1,2) are equations for the current cell
+            assigned = command.split('=', 1)[0].strip()
+            if '=' in command and (is_cell_name(assigned) or is_cell_range(assigned)):
+                cell_name, value = assigned, command.split('=', 1)[1]
 
                 # get input cell(s)
                 target_cells = []
@@ -1783,11 +3792,10 @@ while True:
 
                 # set cells
                 for x, y in target_cells:
-                    target_cell_name = convert_x_to_alpha_value(x) + str(y)
                     if is_equation(value):
-                        equations[target_cell_name] = value[1:].replace(" ", "") # remove equals sign and spaces
+                        set_equation(x, y, convert_equation_to_template(value.replace(" ", "").removeprefix('='), x, y)) # remove equals sign and spaces
                     else:
-                        if target_cell_name in equations: del equations[target_cell_name]
+                        remove_equation(x, y)
                         set_cell(cells, x, y, value)
                 
                 last_x, last_y = target_cells[-1]
@@ -1798,9 +3806,9 @@ while True:
                 x, y = convert_cell_name_to_x_y(current_cell)
                 if is_equation(value):
                     # equations[current_cell] = value[1:].replace(" ", "") # remove equals sign and spaces
-                    equations[current_cell] = value.replace(" ", "") # remove spaces
+                    set_equation(x, y, convert_equation_to_template(value.replace(" ", "").removeprefix('='), x, y)) # remove equals sign and spaces
                 else:
-                    if current_cell in equations: del equations[current_cell]
+                    remove_equation(x, y)
                     set_cell(cells, x, y, value)
                 
                 set_current_cell(x, y, return_type)
@@ -1811,8 +3819,21 @@ while True:
             TRIM_CELLS()
             APPLY_EQUATIONS()
             DISPLAY()
+        elif moved:
+            # keys held down are all moved through before drawing, and moving doesn't change any values
+            drawing_deferred = key_pending()
+            if not drawing_deferred:
+                TRIM_CELLS()
+                DISPLAY()
+        else:
+            # whatever the command printed is on screen now
+            screen_lines.clear()
 
     except Exception as e:
+        screen_lines.clear()
         print(print_red("\n--- ERROR ---"))
         print(e)
         print()
+
+# quitting drops edits that weren't saved
+remove_journal()